@@ -1,30 +1,41 @@
 """
 app.py
 """
-import os
+import io
 
 import streamlit as st
-from openai import OpenAI
-from openai.types.beta.thread_create_params import CodeInterpreterToolParam
 from utils import (
+    clean_up_abandoned_run,
     delete_files,
+    delete_downloads,
     delete_thread,
-    EventHandler,
+    DOWNLOAD_TTL,
+    get_assistant,
+    get_client,
+    get_secret,
+    get_session_key,
     initialise_session_state,
     moderation_endpoint,
+    normalize_uploads,
     render_custom_css,
     render_download_files,
+    merge_answers,
     retrieve_messages_from_thread,
-    retrieve_assistant_created_files
+    retrieve_assistant_created_files,
+    render_run_progress,
+    RUN_BUDGET,
+    sample_csv,
+    split_question,
+    upload_file
     )
+from log_buffer import delete_logs
+from run_registry import run_registry, RunBudget
+from stream_processor import StreamProcessor, transcript_text
+from streamlit_sink import StreamlitSink
 
 # Get secrets
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", st.secrets["OPENAI_API_KEY"])
-ASSISTANT_ID = os.environ.get("OPENAI_ASSISTANT_ID", st.secrets["OPENAI_ASSISTANT_ID"])
-
-# Initialise the OpenAI client, and retrieve the assistant
-client = OpenAI(api_key=OPENAI_API_KEY)
-assistant = client.beta.assistants.retrieve(ASSISTANT_ID)
+# The OpenAI client is only initialised on first use, so the first paint needs no network call
+ASSISTANT_ID = get_secret("OPENAI_ASSISTANT_ID")
 
 st.set_page_config(page_title="DAVE",
                    page_icon="🕵️")
@@ -35,12 +46,119 @@ render_custom_css()
 # Initialise session state variables
 initialise_session_state()
 
+# Progressive mode: sample size used for the preliminary answer
+DEFAULT_SAMPLE_SIZE = 10000
+SAMPLE_INSTRUCTIONS = """
+The attached file(s) are random samples of {sample_rows:,} rows, drawn from {total_rows:,} rows in total.
+Give a preliminary answer, and state clearly at the start of your reply that it is based on a sample.
+"""
+FULL_RUN_MESSAGE = "Now repeat the same analysis on the full dataset(s), and give the definitive answer."
+FULL_INSTRUCTIONS = """
+The attached file(s) are now the full dataset(s). State clearly how the definitive answer differs from the preliminary one, if at all.
+"""
+
+def start_run(question: str, stage: str):
+    """
+    Attaches the file(s) of the stage to the thread, and runs the Assistant on a background worker,
+    which buffers the stream until the run is finished
+
+    Args:
+    - question (str): The question asked
+    - stage (str): "sample" for the preliminary run on the sample(s), "full" for the run on the full dataset(s)
+
+    Returns:
+    - LiveRun: The run
+    """
+    progressive = len(st.session_state.sample_file_id) > 0
+    file_ids = st.session_state.sample_file_id if stage == "sample" else st.session_state.file_id
+
+    # Update the thread to attach the file(s)
+    get_client().beta.threads.update(
+        thread_id=st.session_state.thread_id,
+        tool_resources={"code_interpreter": {"file_ids": [file_id for file_id in file_ids]}}
+        )
+
+    run_kwargs = {}
+    if stage == "sample":
+        run_kwargs["additional_instructions"] = SAMPLE_INSTRUCTIONS.format(sample_rows=st.session_state.sample_rows,
+                                                                           total_rows=st.session_state.total_rows)
+    elif progressive:
+        run_kwargs["additional_instructions"] = FULL_INSTRUCTIONS
+
+    return run_registry.start(get_client(),
+                              session_key,
+                              st.session_state.thread_id,
+                              context=run_context(question, stage),
+                              budget=RunBudget(**RUN_BUDGET),
+                              cleanup=clean_up_abandoned_run,
+                              assistant_id=ASSISTANT_ID,
+                              tool_choice={"type": "code_interpreter"},
+                              temperature=0,
+                              **run_kwargs)
+
+def start_sub_run(question: str, sub_question: str):
+    """
+    Asks a sub-question on a thread of its own, sharing the uploaded file(s), and runs the Assistant
+    on a background worker
+
+    Args:
+    - question (str): The question asked
+    - sub_question (str): The sub-question to answer
+
+    Returns:
+    - LiveRun: The run
+    """
+    thread = get_client().beta.threads.create(
+        messages=[{"role": "user", "content": sub_question}],
+        tool_resources={"code_interpreter": {"file_ids": [file_id for file_id in st.session_state.file_id]}}
+        )
+    print(f"Created new thread: \t {thread.id}")
+
+    return run_registry.start(get_client(),
+                              session_key,
+                              thread.id,
+                              context=run_context(question, "fan_out", sub_question=sub_question),
+                              budget=RunBudget(**RUN_BUDGET),
+                              cleanup=clean_up_abandoned_run,
+                              assistant_id=ASSISTANT_ID,
+                              tool_choice={"type": "code_interpreter"},
+                              temperature=0)
+
+def run_context(question: str, stage: str, **extra) -> dict:
+    """
+    Whatever is needed to finalize a run after a reattach
+    """
+    return {"question": question,
+            "stage": stage,
+            "file_ids": st.session_state.file_id,
+            "sample_file_ids": st.session_state.sample_file_id,
+            "sample_rows": st.session_state.sample_rows,
+            "total_rows": st.session_state.total_rows,
+            **extra}
+
+# Reattach to a run still in flight for this browser session, e.g. after a rerun or a reconnect
+session_key = get_session_key()
+live_runs = run_registry.runs(session_key)
+live_run = live_runs[-1] if live_runs else None
+if live_run is not None:
+    if live_run.context["stage"] != "fan_out":
+        st.session_state.thread_id = live_run.thread_id
+    st.session_state.file_id = live_run.context["file_ids"]
+    st.session_state.sample_file_id = live_run.context["sample_file_ids"]
+    st.session_state.sample_rows = live_run.context["sample_rows"]
+    st.session_state.total_rows = live_run.context["total_rows"]
+    st.session_state["file_uploaded"] = True
+
 # UI
 st.subheader("🔮 DAVE: Data Analysis & Visualisation Engine")
 file_upload_box = st.empty()
+options_box = st.empty()
 upload_btn = st.empty()
 text_box = st.empty()
+fan_out_box = st.empty()
 qn_btn = st.empty()
+stop_btn = st.empty()
+progress_box = st.empty()
 
 # File Upload
 if not st.session_state["file_uploaded"]:
@@ -48,96 +166,212 @@ if not st.session_state["file_uploaded"]:
                                                               accept_multiple_files=True,
                                                               type=["csv"])
 
+    # Progressive mode options
+    with options_box.container():
+        progressive = st.toggle("Progressive mode",
+                                help="For large datasets: get a preliminary answer from a sample first, then the definitive answer from the full dataset(s)")
+        if progressive:
+            sample_size_col, stratify_by_col = st.columns(2)
+            sample_size = sample_size_col.number_input("Sample size (rows)", min_value=100, value=DEFAULT_SAMPLE_SIZE, step=1000)
+            stratify_by = stratify_by_col.text_input("Stratify the sample by column (optional)").strip()
+
     if upload_btn.button("Upload"):
 
+        # Validate and normalize the file(s) locally, so a bad file fails before any upload
+        normalized_files = normalize_uploads(st.session_state["files"])
+        if normalized_files is None:
+            st.stop()
+
+        # The column to stratify by must be in the file(s), so that a typo fails before any upload
+        if progressive and stratify_by:
+            columns = [column for _, _, report in normalized_files for column in report["columns"]]
+            if stratify_by not in columns:
+                st.error(f"There is no column **{stratify_by}** to stratify by. The columns are: {', '.join(dict.fromkeys(columns))}", icon="⚠️")
+                for _, file, _ in normalized_files:
+                    file.close()
+                st.stop()
+            for file_name, _, report in normalized_files:
+                if stratify_by not in report["columns"]:
+                    print(f"Not stratifying: \t {file_name} has no column {stratify_by}")
+
         st.session_state["file_id"] = []
+        st.session_state["sample_file_id"] = []
+        st.session_state["sample_rows"] = 0
+        st.session_state["total_rows"] = 0
 
         # Upload the file
-        for file in st.session_state["files"]:
-            oai_file = client.files.create(
-                file=file,
-                purpose='assistants'
-            )
+        for file_name, file, _ in normalized_files:
+
+            # In progressive mode, upload a sample of the file first
+            if progressive:
+                sample, sample_rows, total_rows = sample_csv(file, sample_size, stratify_by)
+                st.session_state["sample_file_id"].append(upload_file(io.BytesIO(sample), f"sample_{file_name}"))
+                st.session_state["sample_rows"] += sample_rows
+                st.session_state["total_rows"] += total_rows
 
             # Append the file ID to the list
-            st.session_state["file_id"].append(oai_file.id)
-            print(f"Uploaded new file: \t {oai_file.id}")
+            st.session_state["file_id"].append(upload_file(file, file_name))
+            file.close()
 
         st.toast("File(s) uploaded successfully", icon="🚀")
         st.session_state["file_uploaded"] = True
         file_upload_box.empty()
+        options_box.empty()
         upload_btn.empty()
         # The re-run is to trigger the next section of the code
         st.rerun()
 
-if st.session_state["file_uploaded"]:
+if st.session_state["file_uploaded"] and live_run is None:
     
     question = text_box.text_area("Ask a question")
+    fan_out = fan_out_box.toggle("Fan-out mode",
+                                 help="For multi-part questions: answer independent sub-questions in parallel on the full dataset(s), then combine the answers")
 
     # If the button is clicked
     if qn_btn.button("Ask DAVE"):
 
-        # Clear the UI
-        text_box.empty()
-        qn_btn.empty()
-
         # Check if the question is flagged
         if moderation_endpoint(question):
             # if flagged, return a warning message, delete the files and stop the app
+            text_box.empty()
+            fan_out_box.empty()
+            qn_btn.empty()
             st.warning("Your question has been flagged. Refresh page to try again.")
-            delete_files(st.session_state.file_id)
+            delete_files(st.session_state.file_id + st.session_state.sample_file_id)
             st.stop()
 
-        # If there is no text boxes in the session state, create an empty list 
-        # This list will store the text boxes created by the Assistant
-        if "text_boxes" not in st.session_state:
-            st.session_state.text_boxes = []
-
-        # Create a new thread if not already created
-        if "thread_id" not in st.session_state:
-            thread = client.beta.threads.create()
-            st.session_state.thread_id = thread.id
-            print(f"Created new thread: \t {st.session_state.thread_id}")
-
-        # Update the thread to attach the file(s)
-        client.beta.threads.update(
-            thread_id=st.session_state.thread_id,
-            tool_resources={"code_interpreter": {"file_ids": [file_id for file_id in st.session_state.file_id]}}
+        # Fan-out mode: run each sub-question on a thread of its own, in parallel
+        sub_questions = split_question(question) if fan_out else [question]
+        if len(sub_questions) > 1:
+            live_runs = [start_sub_run(question, sub_question) for sub_question in sub_questions]
+            live_run = live_runs[-1]
+
+        else:
+            # Create a new thread if not already created
+            if "thread_id" not in st.session_state:
+                thread = get_client().beta.threads.create()
+                st.session_state.thread_id = thread.id
+                print(f"Created new thread: \t {st.session_state.thread_id}")
+
+            # Ask the question
+            get_client().beta.threads.messages.create(
+                thread_id=st.session_state.thread_id,
+                role="user",
+                content=question,
             )
 
-        # Ask the question
-        client.beta.threads.messages.create(
-            thread_id=st.session_state.thread_id,
-            role="user",
-            content=question,
-        )
+            # In progressive mode, the first run is on the sample(s)
+            live_run = start_run(question, "sample" if st.session_state.sample_file_id else "full")
+
+if live_run is not None:
+
+    # Clear the UI
+    text_box.empty()
+    fan_out_box.empty()
+    qn_btn.empty()
 
-        # Create a new text box to display the question
-        st.session_state.text_boxes.append(st.empty())
-        st.session_state.text_boxes[-1].success(f"**> 🤔 User:** {question}")
+    # The transcript is drawn afresh on every (re)run
+    st.session_state.text_boxes = []
 
-        # Run the Assistant and the EventHandler handles the stream
-        with client.beta.threads.runs.stream(thread_id=st.session_state.thread_id,
-                                             assistant_id=assistant.id,
-                                             tool_choice={"type": "code_interpreter"},
-                                             event_handler=EventHandler(),
-                                             temperature=0) as stream:
-            stream.until_done()
-            st.toast("DAVE has finished analysing the data", icon="🕵️")
+    # The Stop button reruns the script, which reattaches to the run(s) and stops them
+    followed_runs = [sub_run for sub_run in live_runs if sub_run.context["stage"] == "fan_out"] if live_run.context["stage"] == "fan_out" else [live_run]
+    if stop_btn.button("⏹️ Stop", key="stop_run"):
+        for followed_run in followed_runs:
+            followed_run.stop("Stopped by the user")
+
+    def on_progress(followed_runs: list) -> None:
+        """
+        Renders the usage of the run(s) while they are followed
+        """
+        render_run_progress(progress_box, followed_runs)
+
+    # Create a new text box to display the question
+    st.session_state.text_boxes.append(st.empty())
+    st.session_state.text_boxes[-1].success(f"**> 🤔 User:** {live_run.context['question']}")
+
+    # A run whose stream failed is reported, and cleaned up like the others
+    finished_runs = followed_runs
+    run_error = None
+    try:
+        # Fan-out mode: stream the sub-questions side by side, then combine their answers
+        if live_run.context["stage"] == "fan_out":
+            followed = []
+            for column, sub_run in zip(st.columns(len(finished_runs)), finished_runs):
+                column.markdown(f"**🧩 {sub_run.context['sub_question']}**")
+                followed.append((sub_run, StreamProcessor(StreamlitSink(column))))
+            run_registry.follow_all(followed, on_progress=on_progress)
+
+            with st.spinner("Combining the answers..."):
+                # The answers are already in the transcripts, with no need to fetch them
+                answers = [transcript_text(processor.items) for _, processor in followed]
+                merged_answer = merge_answers(live_run.context["question"],
+                                              [sub_run.context["sub_question"] for sub_run in finished_runs],
+                                              answers,
+                                              get_assistant(ASSISTANT_ID).model)
+            with st.container(border=True):
+                st.markdown("**> 🕵️ DAVE:**")
+                st.write_stream(merged_answer)
+
+        else:
+            # Progressive mode: stream the preliminary answer, then re-run on the full dataset(s), unless stopped
+            if live_run.context["stage"] == "sample":
+                st.session_state.text_boxes.append(st.empty())
+                st.session_state.text_boxes[-1].warning(f"**⏳ Preliminary answer**, based on a sample of {live_run.context['sample_rows']:,} of {live_run.context['total_rows']:,} rows")
+                run_registry.follow(live_run, StreamProcessor(StreamlitSink()), on_progress=on_progress)
+
+                if live_run.stop_reason is None:
+                    run_registry.release(live_run)
+                    get_client().beta.threads.messages.create(
+                        thread_id=st.session_state.thread_id,
+                        role="user",
+                        content=FULL_RUN_MESSAGE,
+                    )
+                    live_run = start_run(live_run.context["question"], "full")
+                    finished_runs = [live_run]
+
+            if live_run.context["stage"] == "full":
+                if live_run.context["sample_file_ids"]:
+                    st.session_state.text_boxes.append(st.empty())
+                    st.session_state.text_boxes[-1].info(f"**✅ Definitive answer**, based on all {live_run.context['total_rows']:,} rows")
+
+                # Replay what has been streamed so far, and the processor handles the rest of the stream
+                run_registry.follow(live_run, StreamProcessor(StreamlitSink()), on_progress=on_progress)
+    except Exception as exc:
+        run_error = exc
+        # The error may come from drawing the run rather than from its stream: stop whatever still runs,
+        # as it is released below, out of reach of the budget and orphan checks
+        for finished_run in finished_runs:
+            if not finished_run.done:
+                finished_run.stop("Stopped after an error")
+
+    stop_btn.empty()
+    stop_reasons = [finished_run.stop_reason for finished_run in finished_runs if finished_run.stop_reason is not None]
+    st.session_state.assistant_created_file_ids = []
+    if run_error is not None:
+        st.error(f"DAVE could not finish analysing the data ({run_error}). Please try again.")
+    else:
+        if stop_reasons:
+            st.warning(f"⏹️ {stop_reasons[0]}: the analysis was stopped, and only what was done so far is shown.")
+        st.toast("DAVE has finished analysing the data", icon="🕵️")
 
         # Prepare the files for download
         with st.spinner("Preparing the files for download..."):
-            # Retrieve the messages by the Assistant from the thread
-            assistant_messages = retrieve_messages_from_thread(st.session_state.thread_id)
-            # For each assistant message, retrieve the file(s) created by the Assistant
-            st.session_state.assistant_created_file_ids = retrieve_assistant_created_files(assistant_messages)
-            # Download these files
-            st.session_state.download_files, st.session_state.download_file_names = render_download_files(st.session_state.assistant_created_file_ids)
-
-        # Clean-up
-        # Delete the file(s) uploaded
-        delete_files(st.session_state.file_id)
-        # Delete the file(s) created by the Assistant
-        delete_files(st.session_state.assistant_created_file_ids)
+            for finished_run in finished_runs:
+                # Retrieve the messages by the Assistant from the thread
+                assistant_messages = retrieve_messages_from_thread(finished_run.thread_id)
+                # For each assistant message, retrieve the file(s) created by the Assistant
+                st.session_state.assistant_created_file_ids += retrieve_assistant_created_files(assistant_messages, finished_run.thread_id)
+            # Render the download buttons, the files are only fetched when clicked
+            render_download_files(st.session_state.assistant_created_file_ids)
+
+    # Clean-up
+    for finished_run in finished_runs:
+        run_registry.release(finished_run)
         # Delete the thread
-        delete_thread(st.session_state.thread_id)
+        delete_thread(finished_run.thread_id)
+    # Delete the full logs, once the user has had the time to open them
+    run_registry.defer(DOWNLOAD_TTL, delete_logs, [finished_run.thread_id for finished_run in finished_runs])
+    # Delete the file(s) uploaded
+    delete_files(st.session_state.file_id + st.session_state.sample_file_id)
+    # Delete the file(s) created by the Assistant, once the user has had the time to download them
+    run_registry.defer(DOWNLOAD_TTL, delete_downloads, st.session_state.assistant_created_file_ids)
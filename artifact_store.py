@@ -0,0 +1,126 @@
+"""
+artifact_store.py
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Iterable
+
+# Stored copies younger than this are never pruned, as they may not be linked yet
+PRUNE_GRACE_PERIOD = 60
+# Counts of the work saved by deduplication, for this process
+_stats = {"stored": 0, "duplicates": 0, "bytes_saved": 0, "encodes_skipped": 0}
+_stats_lock = threading.Lock()
+
+
+def record_dedup(name: str, count: int = 1) -> None:
+    """
+    Add to a deduplication counter, see `artifact_stats`
+    """
+    with _stats_lock:
+        _stats[name] += count
+
+
+def artifact_stats() -> dict:
+    """
+    The deduplication counters of the process: the artifacts stored, the duplicates found,
+    the bytes they would have taken on disk, and the encodings skipped
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+class ArtifactStore:
+    """
+    Keeps the files created by the Assistant by the SHA-256 of their content, so that duplicates,
+    within and across sessions, share a single copy on disk. Each file is a hard link to its copy,
+    which is deleted by `prune` once nothing links to it.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.object_dir = os.path.join(root, "objects")
+
+    def object_path(self, digest: str) -> str:
+        """
+        Where the content with this digest is kept
+        """
+        return os.path.join(self.object_dir, digest)
+
+    def put(self, chunks: Iterable[bytes], path: str) -> str:
+        """
+        Stream content into the store, hashing it on the way, and link the path to the stored copy
+
+        Args:
+        - chunks (Iterable[bytes]): The content
+        - path (str): Where the file is expected
+
+        Returns:
+        - str: The digest of the content
+        """
+        os.makedirs(self.object_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        part_path = os.path.join(self.object_dir, f"{uuid.uuid4().hex}.part")
+        with open(part_path, "wb") as file:
+            for chunk in chunks:
+                digest.update(chunk)
+                file.write(chunk)
+                size += len(chunk)
+        object_path = self.object_path(digest.hexdigest())
+
+        if os.path.exists(object_path):
+            os.remove(part_path)
+            record_dedup("duplicates")
+            record_dedup("bytes_saved", size)
+            print(f"Deduplicated file: \t {os.path.basename(path)} ({size:,} bytes)")
+        else:
+            os.replace(part_path, object_path)
+            record_dedup("stored")
+        self.link(object_path, path)
+        return digest.hexdigest()
+
+    def link(self, object_path: str, path: str) -> None:
+        """
+        Make the path point to a stored copy, copying it where hard links are not supported
+        """
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            os.link(object_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(object_path, path)
+
+    def prune(self) -> int:
+        """
+        Delete the stored copies which no file links to anymore
+
+        Returns:
+        - int: The number of copies deleted
+        """
+        deleted = 0
+        if not os.path.isdir(self.object_dir):
+            return deleted
+        cutoff = time.time() - PRUNE_GRACE_PERIOD
+        for entry in os.scandir(self.object_dir):
+            stat = entry.stat()
+            if not entry.name.endswith(".part") and stat.st_nlink <= 1 and stat.st_mtime < cutoff:
+                os.remove(entry.path)
+                deleted += 1
+        return deleted
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    The SHA-256 of a file saved on disk
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
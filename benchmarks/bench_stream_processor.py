@@ -0,0 +1,85 @@
+"""
+benchmarks/bench_stream_processor.py
+
+Profiles the stream-processing core in isolation, with no frontend: the time per event of
+`StreamProcessor` with a sink doing nothing, as the answer grows, against the OpenAI SDK's
+`AssistantEventHandler` fed the same events, deep-copied as replays used to require.
+
+Usage:
+    python benchmarks/bench_stream_processor.py [--deltas 1000,10000,100000]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stream_events(deltas: int) -> list:
+    """
+    A run with a code interpreter step, then an answer of `deltas` text deltas
+    """
+    from openai._models import construct_type
+    from openai.types.beta import AssistantStreamEvent
+
+    tool_call = {"id": "call_1", "type": "code_interpreter",
+                 "code_interpreter": {"input": "print(1)", "outputs": [{"type": "logs", "logs": "1"}]}}
+    step = {"id": "step_1", "object": "thread.run.step", "thread_id": "thread_1", "run_id": "run_1",
+            "type": "tool_calls", "status": "in_progress", "step_details": {"type": "tool_calls", "tool_calls": []}}
+    message = {"id": "msg_1", "object": "thread.message", "thread_id": "thread_1", "run_id": "run_1",
+               "role": "assistant", "status": "in_progress", "content": []}
+    raw_events = [
+        ("thread.run.step.created", step),
+        ("thread.run.step.delta", {"id": "step_1", "object": "thread.run.step.delta", "delta": {"step_details": {
+            "type": "tool_calls", "tool_calls": [{"index": 0, **tool_call}]}}}),
+        ("thread.run.step.completed", {**step, "status": "completed",
+                                       "step_details": {"type": "tool_calls", "tool_calls": [tool_call]}}),
+        ("thread.message.created", message),
+    ]
+    raw_events += [("thread.message.delta", {"id": "msg_1", "object": "thread.message.delta", "delta": {"content": [
+        {"index": 0, "type": "text", "text": {"value": " word", "annotations": []}}]}})] * deltas
+    raw_events += [("thread.message.completed", {**message, "status": "completed", "content": [
+        {"type": "text", "text": {"value": " word" * deltas, "annotations": []}}]})]
+    return [construct_type(type_=AssistantStreamEvent, value={"event": event, "data": data})
+            for event, data in raw_events]
+
+
+def time_per_event(feed, events: list) -> float:
+    """
+    Feeds the events one at a time
+
+    Returns:
+    - float: The microseconds per event, over the last tenth of the events, when the answer is longest
+    """
+    tail = len(events) - len(events) // 10
+    for event in events[:tail]:
+        feed(event)
+    start = time.perf_counter()
+    for event in events[tail:]:
+        feed(event)
+    return (time.perf_counter() - start) / (len(events) - tail) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deltas", default="1000,10000,100000", help="Comma-separated numbers of text deltas")
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    from openai import AssistantEventHandler
+
+    from stream_processor import StreamProcessor
+
+    print("| Text deltas | StreamProcessor (µs/event) | AssistantEventHandler + deep copy (µs/event) |")
+    print("|---|---|---|")
+    for deltas in [int(deltas) for deltas in args.deltas.split(",")]:
+        events = stream_events(deltas)
+        processor = StreamProcessor()
+        processor_us = time_per_event(processor.process, events)
+        handler = AssistantEventHandler()
+        handler_us = time_per_event(lambda event: handler._emit_sse_event(event.model_copy(deep=True)), events)
+        print(f"| {deltas:,} | {processor_us:.2f} | {handler_us:.2f} |", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+benchmarks/fake_openai.py
+
+A local stand-in for the parts of the OpenAI API used by the apps, with configurable latencies.
+Runs stream a short analysis: a code interpreter step with its logs, then a text answer whose
+first token is `FIRST_TOKEN`, so a client can time the first token it renders, then a chart.
+Every run creates a new chart file with the same content, as when sessions ask the same question.
+
+Usage:
+    python benchmarks/fake_openai.py [--port 8765] [--latency-ms 50] [--token-interval-ms 20] [--tokens 50]
+"""
+import argparse
+import itertools
+import json
+import re
+import struct
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIRST_TOKEN = "FIRST-TOKEN"
+CODE = "import pandas as pd\ndf = pd.read_csv('/mnt/data/file')\nprint(df.describe())\n"
+LOGS = "       resale_price\ncount  1.000000e+05\nmean   4.860000e+05\n"
+
+_ids = itertools.count(1)
+
+
+def chart_png(width: int = 600, height: int = 400) -> bytes:
+    """
+    A PNG image standing in for a chart
+    """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # A gradient, one RGB pixel after the other, each row starting with its filter type
+    rows = b"".join(b"\x00" + bytes(value for x in range(width) for value in (x * 255 // width, y * 255 // height, 128))
+                    for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+
+CHART = chart_png()
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{next(_ids):08d}"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Serves the endpoints used by the apps, after `latency_ms`
+    """
+    protocol_version = "HTTP/1.1"
+    latency_ms = 50
+    token_interval_ms = 20
+    tokens = 50
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/json") and body:
+            return json.loads(body)
+        return {}
+
+    def _send_json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, event: str, data: dict) -> None:
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        time.sleep(self.latency_ms / 1000)
+        path = self.path.split("?")[0]
+        if re.fullmatch(r"/v1/files/[^/]+/content", path):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(CHART)))
+            self.end_headers()
+            self.wfile.write(CHART)
+        elif match := re.fullmatch(r"/v1/assistants/([^/]+)", path):
+            self._send_json({"id": match[1], "object": "assistant", "created_at": 0, "model": "gpt-4-fake",
+                             "name": "Data Analyst", "instructions": "", "tools": [{"type": "code_interpreter"}],
+                             "metadata": {}})
+        elif re.fullmatch(r"/v1/threads/[^/]+/messages", path):
+            self._send_json({"object": "list", "data": [], "first_id": None, "last_id": None, "has_more": False})
+        elif match := re.fullmatch(r"/v1/files/([^/]+)", path):
+            self._send_json({"id": match[1], "object": "file", "bytes": 1024, "created_at": 0,
+                             "filename": "output.csv", "purpose": "assistants", "status": "processed"})
+        else:
+            self._send_json({"error": {"message": f"Not found: {path}"}}, status=404)
+
+    def do_DELETE(self) -> None:
+        time.sleep(self.latency_ms / 1000)
+        object_id = self.path.rstrip("/").split("/")[-1]
+        self._send_json({"id": object_id, "object": "deleted", "deleted": True})
+
+    def do_POST(self) -> None:
+        time.sleep(self.latency_ms / 1000)
+        path = self.path.split("?")[0]
+        body = self._read_json()
+        if path == "/v1/moderations":
+            self._send_json({"id": new_id("modr"), "model": "text-moderation-fake",
+                             "results": [{"flagged": False, "categories": {}, "category_scores": {}}]})
+        elif path == "/v1/files":
+            self._send_json({"id": new_id("file"), "object": "file", "bytes": 0, "created_at": 0,
+                             "filename": "upload.csv", "purpose": "assistants", "status": "processed"})
+        elif path == "/v1/threads" or re.fullmatch(r"/v1/threads/[^/]+", path):
+            thread_id = path.split("/")[-1] if path != "/v1/threads" else new_id("thread")
+            self._send_json({"id": thread_id, "object": "thread", "created_at": 0, "metadata": {},
+                             "tool_resources": body.get("tool_resources")})
+        elif match := re.fullmatch(r"/v1/threads/([^/]+)/messages", path):
+            self._send_json(self._message(match[1], None, "user", body.get("content", ""), "completed"))
+        elif match := re.fullmatch(r"/v1/threads/([^/]+)/runs/([^/]+)/cancel", path):
+            self._send_json(self._run(match[1], match[2], "cancelling"))
+        elif match := re.fullmatch(r"/v1/threads/([^/]+)/runs", path):
+            self._stream_run(match[1])
+        elif path == "/v1/chat/completions":
+            self._chat_completion(body)
+        else:
+            self._send_json({"error": {"message": f"Not found: {path}"}}, status=404)
+
+    @staticmethod
+    def _run(thread_id: str, run_id: str, status: str) -> dict:
+        return {"id": run_id, "object": "thread.run", "created_at": 0, "thread_id": thread_id,
+                "assistant_id": "asst_fake", "status": status, "model": "gpt-4-fake", "instructions": "",
+                "tools": [{"type": "code_interpreter"}], "metadata": {}, "usage": None}
+
+    @staticmethod
+    def _message(thread_id: str, run_id, role: str, text, status: str) -> dict:
+        content = [] if text is None else [{"type": "text", "text": {"value": text, "annotations": []}}]
+        return {"id": new_id("msg"), "object": "thread.message", "created_at": 0, "thread_id": thread_id,
+                "role": role, "content": content, "status": status, "assistant_id": "asst_fake",
+                "run_id": run_id, "attachments": [], "metadata": {}}
+
+    @staticmethod
+    def _step(thread_id: str, run_id: str, step_id: str, tool_calls: list, status: str, usage=None) -> dict:
+        return {"id": step_id, "object": "thread.run.step", "created_at": 0, "thread_id": thread_id,
+                "run_id": run_id, "assistant_id": "asst_fake", "type": "tool_calls", "status": status,
+                "step_details": {"type": "tool_calls", "tool_calls": tool_calls}, "usage": usage}
+
+    def _stream_run(self, thread_id: str) -> None:
+        """
+        Streams a run: a code interpreter step, then the answer, one token every `token_interval_ms`
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        interval = self.token_interval_ms / 1000
+        run_id, step_id = new_id("run"), new_id("step")
+        try:
+            self._send_event("thread.run.created", self._run(thread_id, run_id, "queued"))
+            self._send_event("thread.run.in_progress", self._run(thread_id, run_id, "in_progress"))
+
+            # Code interpreter step
+            tool_call = {"id": new_id("call"), "type": "code_interpreter",
+                         "code_interpreter": {"input": "", "outputs": []}}
+            self._send_event("thread.run.step.created", self._step(thread_id, run_id, step_id, [], "in_progress"))
+            for line in CODE.splitlines(keepends=True):
+                time.sleep(interval)
+                self._send_event("thread.run.step.delta", {
+                    "id": step_id, "object": "thread.run.step.delta",
+                    "delta": {"step_details": {"type": "tool_calls", "tool_calls": [
+                        {"index": 0, "id": tool_call["id"], "type": "code_interpreter",
+                         "code_interpreter": {"input": line, "outputs": []}}]}}})
+            self._send_event("thread.run.step.delta", {
+                "id": step_id, "object": "thread.run.step.delta",
+                "delta": {"step_details": {"type": "tool_calls", "tool_calls": [
+                    {"index": 0, "type": "code_interpreter",
+                     "code_interpreter": {"outputs": [{"index": 0, "type": "logs", "logs": LOGS}]}}]}}})
+            tool_call["code_interpreter"] = {"input": CODE, "outputs": [{"type": "logs", "logs": LOGS}]}
+            self._send_event("thread.run.step.completed", self._step(
+                thread_id, run_id, step_id, [tool_call], "completed",
+                usage={"prompt_tokens": 1000, "completion_tokens": 100, "total_tokens": 1100}))
+
+            # Answer
+            message = self._message(thread_id, run_id, "assistant", None, "in_progress")
+            self._send_event("thread.message.created", message)
+            words = [FIRST_TOKEN] + [f" word{index}" for index in range(1, self.tokens)]
+            for word in words:
+                time.sleep(interval)
+                self._send_event("thread.message.delta", {
+                    "id": message["id"], "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": word, "annotations": []}}]}})
+            chart = {"type": "image_file", "image_file": {"file_id": new_id("file")}}
+            self._send_event("thread.message.delta", {
+                "id": message["id"], "object": "thread.message.delta",
+                "delta": {"content": [{"index": 1, **chart}]}})
+            self._send_event("thread.message.completed",
+                             {**message, "status": "completed",
+                              "content": [{"type": "text", "text": {"value": "".join(words), "annotations": []}},
+                                          chart]})
+            self._send_event("thread.run.completed", self._run(thread_id, run_id, "completed"))
+            self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _chat_completion(self, body: dict) -> None:
+        """
+        Answers chat completions: sub-questions as JSON, anything else as text
+        """
+        if body.get("response_format", {}).get("type") == "json_object":
+            content = json.dumps({"sub_questions": ["What is the mean?", "What is the maximum?"]})
+        else:
+            content = "0" if body.get("max_tokens") == 1 else "Combined answer."
+        if not body.get("stream"):
+            self._send_json({"id": new_id("chatcmpl"), "object": "chat.completion", "created": 0, "model": body.get("model"),
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": content}}]})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk = {"id": new_id("chatcmpl"), "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                 "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def serve(port: int, latency_ms: float, token_interval_ms: float, tokens: int) -> None:
+    FakeOpenAIHandler.latency_ms = latency_ms
+    FakeOpenAIHandler.token_interval_ms = token_interval_ms
+    FakeOpenAIHandler.tokens = tokens
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    print(f"Fake OpenAI API listening on http://127.0.0.1:{port}/v1", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of every request")
+    parser.add_argument("--token-interval-ms", type=float, default=20, help="Time between two streamed tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="Number of tokens in an answer")
+    args = parser.parse_args()
+    serve(args.port, args.latency_ms, args.token_interval_ms, args.tokens)
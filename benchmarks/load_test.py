@@ -0,0 +1,329 @@
+"""
+benchmarks/load_test.py
+
+Drives N concurrent sessions through each app, against the local fake OpenAI API of
+`fake_openai.py`, and reports as concurrency rises:
+- the p95 time to first token, from the question being asked to its first answer token being drawn
+- the lag of an asyncio event loop ticking in the same process, standing in for the server's event loop
+- the memory per session, from the peak resident memory of the process
+- what deduplicating the charts saved: every run creates the same chart, under a new file id
+- the sessions a process can serve, i.e. the highest concurrency within the latency objectives
+
+Each session is a Streamlit AppTest with a session key of its own, so that sessions share the
+process-wide run registry and caches as browser sessions do. AppTest cannot upload files, so the
+sessions of `app.py` and `chat_app.py` start with their file(s) already uploaded.
+
+Usage:
+    python benchmarks/load_test.py [--apps app.py,demo_app.py,chat_app.py] [--levels 1,2,4,8,16]
+                                   [--latency-ms 50] [--token-interval-ms 20] [--tokens 50]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from fake_openai import FIRST_TOKEN
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ["app.py", "demo_app.py", "chat_app.py"]
+SECRETS = {
+    "OPENAI_API_KEY": "sk-benchmark",
+    "OPENAI_ASSISTANT_ID": "asst_benchmark",
+    "ASSISTANT_ID": "asst_benchmark",
+    "FILE_ID": "file-benchmark",
+}
+QUESTION = "What is the average resale price?"
+# How often the stand-in event loop ticks
+LOOP_TICK = 0.01
+
+
+def start_fake_openai(port: int, latency_ms: float, token_interval_ms: float, tokens: int) -> subprocess.Popen:
+    """
+    Starts the fake OpenAI API in a process of its own, so that it does not compete for the GIL
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "fake_openai.py"),
+                                "--port", str(port),
+                                "--latency-ms", str(latency_ms),
+                                "--token-interval-ms", str(token_interval_ms),
+                                "--tokens", str(tokens)],
+                               stdout=subprocess.PIPE, text=True)
+    # Wait until it listens
+    process.stdout.readline()
+    return process
+
+
+def rss_bytes() -> int:
+    """
+    The resident memory of the process
+    """
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def p95(values: list) -> float:
+    if not values:
+        return float("nan")
+    return statistics.quantiles(values, n=20, method="inclusive")[-1] if len(values) > 1 else values[0]
+
+
+class ProcessMonitor:
+    """
+    Ticks an asyncio event loop on a thread of its own, recording how late each tick is,
+    and samples the peak resident memory meanwhile
+    """
+    def __init__(self):
+        self.lags = []
+        self.peak_rss = rss_bytes()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._tick(), self._loop)
+
+    async def _tick(self) -> None:
+        while True:
+            scheduled = time.perf_counter() + LOOP_TICK
+            await asyncio.sleep(LOOP_TICK)
+            self.lags.append(max(time.perf_counter() - scheduled, 0))
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+
+    def reset(self) -> None:
+        self.lags = []
+        self.peak_rss = rss_bytes()
+
+
+class FirstTokenTracker:
+    """
+    Records when the first answer token is drawn in each session, by watching the messages
+    the script runs send to the browser
+    """
+    def __init__(self):
+        self.first_token_at = {}
+        self._lock = threading.Lock()
+
+    def install(self) -> None:
+        from urllib.parse import parse_qs
+
+        from streamlit.runtime.scriptrunner.script_run_context import ScriptRunContext
+
+        tracker = self
+        enqueue = ScriptRunContext.enqueue
+
+        def tracked_enqueue(self, msg) -> None:
+            if msg.WhichOneof("type") == "delta":
+                element = msg.delta.new_element
+                if FIRST_TOKEN in element.markdown.body or FIRST_TOKEN in element.alert.body:
+                    session_key = parse_qs(self.query_string).get("sid", [""])[0]
+                    with tracker._lock:
+                        tracker.first_token_at.setdefault(session_key, time.perf_counter())
+            enqueue(self, msg)
+
+        ScriptRunContext.enqueue = tracked_enqueue
+
+
+def share_app_test_globals() -> None:
+    """
+    AppTest sets up a mock runtime and the test config for each script run, and tears them down
+    once the run is over, which would pull them from under the concurrent sessions: set them up once
+    for all sessions instead. The compiled scripts are shared too, as in a server, where each script
+    is compiled once: compiling in several threads at once can fail on Python 3.11.7 and older
+    ("AST constructor recursion depth mismatch").
+    """
+    import contextlib
+    from unittest.mock import MagicMock
+
+    from streamlit import config
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    shared_runtime = MagicMock(spec=Runtime)
+    shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: cls._instance or shared_runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda config_options: contextlib.nullcontext()
+    shared_script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: shared_script_cache
+
+
+def run_session(app: str, session_key: str, start_barrier: threading.Barrier, tracker: FirstTokenTracker) -> dict:
+    """
+    Opens the app in a new session, waits for the other sessions, then asks a question
+
+    Returns:
+    - dict: The timings of the session, and its AppTest, kept alive to measure its memory
+    """
+    from streamlit.testing.v1 import AppTest
+
+    app_test = AppTest.from_file(os.path.join(ROOT, app), default_timeout=300)
+    app_test.query_params["sid"] = session_key
+    if app in ["app.py", "chat_app.py"]:
+        app_test.session_state["file_uploaded"] = True
+        app_test.session_state["file_id"] = ["file-benchmark"]
+    if app == "app.py":
+        app_test.session_state["sample_file_id"] = []
+        app_test.session_state["sample_rows"] = 0
+        app_test.session_state["total_rows"] = 0
+
+    start = time.perf_counter()
+    app_test.run()
+    first_paint = time.perf_counter() - start
+
+    # Ask at the same time as the other sessions
+    start_barrier.wait()
+    asked_at = time.perf_counter()
+    if app == "chat_app.py":
+        app_test.chat_input[0].set_value(QUESTION).run()
+    else:
+        app_test.text_area[0].input(QUESTION)
+        next(button for button in app_test.button if button.label == "Ask DAVE").click().run()
+    answered_at = time.perf_counter()
+
+    first_token_at = tracker.first_token_at.get(session_key)
+    return {"app_test": app_test,
+            "first_paint": first_paint,
+            "ttft": first_token_at - asked_at if first_token_at is not None else None,
+            "turn": answered_at - asked_at,
+            "error": app_test.exception[0].message if app_test.exception else None}
+
+
+def run_level(app: str, sessions: int, tracker: FirstTokenTracker, monitor: ProcessMonitor) -> dict:
+    """
+    Runs `sessions` concurrent sessions of the app
+
+    Returns:
+    - dict: The measurements of the level
+    """
+    import gc
+
+    from artifact_store import artifact_stats
+    from cache import cache_stats
+
+    def cache_counts() -> tuple:
+        """
+        The hits and misses of every cache together
+        """
+        stats = cache_stats().values()
+        return sum(counts["hits"] for counts in stats), sum(counts["misses"] for counts in stats)
+
+    gc.collect()
+    stats_before = artifact_stats()
+    cache_before = cache_counts()
+    baseline_rss = rss_bytes()
+    monitor.reset()
+    start_barrier = threading.Barrier(sessions)
+    results = [None] * sessions
+
+    def session(index: int) -> None:
+        try:
+            results[index] = run_session(app, f"load-{uuid.uuid4().hex}", start_barrier, tracker)
+        except Exception as exc:
+            start_barrier.abort()
+            results[index] = {"error": repr(exc)}
+
+    threads = [threading.Thread(target=session, args=(index,)) for index in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lags = list(monitor.lags)
+    ttfts = [result["ttft"] for result in results if result.get("ttft") is not None]
+    turns = [result["turn"] for result in results if "turn" in result]
+    errors = [result["error"] for result in results if result.get("error")]
+    stats = artifact_stats()
+    cache_after = cache_counts()
+    return {"sessions": sessions,
+            "ttft_p95": p95(ttfts),
+            "turn_p95": p95(turns),
+            "lag_p95": p95(lags),
+            "lag_max": max(lags, default=float("nan")),
+            "rss_per_session": (monitor.peak_rss - baseline_rss) / sessions,
+            "missing_first_tokens": sessions - len(ttfts),
+            "charts_stored": stats["stored"] - stats_before["stored"],
+            "charts_deduplicated": stats["duplicates"] - stats_before["duplicates"],
+            "bytes_saved": stats["bytes_saved"] - stats_before["bytes_saved"],
+            "encodes_skipped": stats["encodes_skipped"] - stats_before["encodes_skipped"],
+            "cache_hits": cache_after[0] - cache_before[0],
+            "cache_misses": cache_after[1] - cache_before[1],
+            "errors": errors}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apps", default=",".join(APPS), help="Comma-separated apps to load")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated numbers of concurrent sessions")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of every fake API request")
+    parser.add_argument("--token-interval-ms", type=float, default=20, help="Time between two streamed tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="Number of tokens in an answer")
+    parser.add_argument("--ttft-slo", type=float, default=2.0, help="Objective for the p95 time to first token (s)")
+    parser.add_argument("--lag-slo", type=float, default=0.1, help="Objective for the p95 event loop lag (s)")
+    args = parser.parse_args()
+
+    # Point the apps at the fake API, and keep their stores and files out of the working tree
+    store_dir = tempfile.mkdtemp(prefix="dave-load-test-")
+    os.environ.update(SECRETS)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["DAVE_TRANSCRIPT_DB"] = os.path.join(store_dir, "transcripts.db")
+    os.environ["DAVE_CACHE_PATH"] = os.path.join(store_dir, "cache.db")
+    os.chdir(store_dir)
+    sys.path.insert(0, ROOT)
+
+    # The secrets are shared by all sessions, as in a server
+    import streamlit as st
+    from streamlit.runtime.secrets import Secrets
+    st.secrets = Secrets([])
+    st.secrets._secrets = dict(SECRETS)
+
+    # The report goes to stdout, while whatever the apps print and log is dropped
+    report = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    share_app_test_globals()
+    fake_openai = start_fake_openai(args.port, args.latency_ms, args.token_interval_ms, args.tokens)
+    tracker = FirstTokenTracker()
+    tracker.install()
+    monitor = ProcessMonitor()
+    try:
+        print(f"Fake API: {args.latency_ms:g} ms per request, {args.tokens} tokens every {args.token_interval_ms:g} ms\n", file=report)
+        for app in args.apps.split(","):
+            # Warm up the imports and caches, so that the first level is not penalised
+            run_level(app, 1, tracker, monitor)
+
+            print(f"## {app}\n", file=report)
+            print("| Sessions | p95 TTFT (s) | p95 turn (s) | p95 loop lag (ms) | Max loop lag (ms) | Memory per session (MB) | Charts stored / deduplicated | Saved (MB) | Encodes skipped | Cache hits / misses | Errors |", file=report)
+            print("|---|---|---|---|---|---|---|---|---|---|---|", file=report)
+            sessions_per_process = 0
+            for sessions in [int(level) for level in args.levels.split(",")]:
+                level = run_level(app, sessions, tracker, monitor)
+                errors = len(level["errors"]) + level["missing_first_tokens"]
+                print(f"| {sessions} | {level['ttft_p95']:.2f} | {level['turn_p95']:.2f} "
+                      f"| {level['lag_p95'] * 1000:.0f} | {level['lag_max'] * 1000:.0f} "
+                      f"| {level['rss_per_session'] / 2 ** 20:.1f} "
+                      f"| {level['charts_stored']} / {level['charts_deduplicated']} | {level['bytes_saved'] / 2 ** 20:.1f} "
+                      f"| {level['encodes_skipped']} | {level['cache_hits']} / {level['cache_misses']} "
+                      f"| {errors} |", file=report, flush=True)
+                for error in sorted(set(level["errors"])):
+                    print(f"|   | {error.splitlines()[0]} | | | | | | | | | |", file=report)
+                if errors == 0 and level["ttft_p95"] <= args.ttft_slo and level["lag_p95"] <= args.lag_slo:
+                    sessions_per_process = sessions
+            print(f"\nSessions per process within a p95 TTFT of {args.ttft_slo:g}s "
+                  f"and a p95 loop lag of {args.lag_slo * 1000:g} ms: {sessions_per_process}\n", file=report)
+    finally:
+        fake_openai.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+benchmarks/startup.py
+
+Measures the cold start of the apps:
+- the import-time profile of `utils.py`, from `python -X importtime`
+- the time to first paint of each app, in a fresh process with Streamlit's AppTest,
+  and the number of network calls made before it
+
+Usage:
+    python benchmarks/startup.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ["app.py", "demo_app.py", "chat_app.py"]
+SECRETS = {
+    "OPENAI_API_KEY": "sk-benchmark",
+    "OPENAI_ASSISTANT_ID": "asst_benchmark",
+    "ASSISTANT_ID": "asst_benchmark",
+    "FILE_ID": "file-benchmark",
+}
+
+
+def profile_imports(module: str = "utils") -> dict:
+    """
+    Profiles the import of a module in a fresh process
+
+    Returns:
+    - dict: The cumulative import time of the module, and of each module it imports directly
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, "OPENAI_API_KEY": SECRETS["OPENAI_API_KEY"]})
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace("|", ":").split(":", 3)
+        # Nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append((name.strip(), depth, int(cumulative_us)))
+
+    # The module's own line comes after the lines of everything it imports
+    index = next(index for index, (name, depth, _) in enumerate(timings) if name == module and depth == 0)
+    direct_imports = []
+    for name, depth, cumulative_us in reversed(timings[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct_imports.append((name, cumulative_us / 1000))
+    return {"total_ms": timings[index][2] / 1000,
+            "direct_imports": sorted(direct_imports, key=lambda timing: timing[1], reverse=True)}
+
+
+def first_paint(app: str) -> dict:
+    """
+    Runs an app once with AppTest, with the network cut off, and times it.
+    Meant to be run in a fresh process.
+    """
+    import httpx
+    from streamlit.testing.v1 import AppTest
+
+    network_calls = []
+
+    def send(self, request, *args, **kwargs):
+        network_calls.append(str(request.url))
+        raise httpx.ConnectError("Network is cut off for the benchmark", request=request)
+
+    httpx.Client.send = send
+
+    start = time.perf_counter()
+    app_test = AppTest.from_file(os.path.join(ROOT, app), default_timeout=60)
+    for key, value in SECRETS.items():
+        app_test.secrets[key] = value
+    app_test.run()
+    elapsed = time.perf_counter() - start
+    return {"app": app,
+            "first_paint_ms": elapsed * 1000,
+            "network_calls": network_calls,
+            "exception": [exception.message for exception in app_test.exception]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of cold starts per measurement")
+    parser.add_argument("--app", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: a single cold start of a single app
+    if args.app:
+        sys.path.insert(0, ROOT)
+        print(json.dumps(first_paint(args.app)))
+        return
+
+    profiles = [profile_imports() for _ in range(args.repeat)]
+    print(f"## Import of utils.py (median of {args.repeat} cold imports)\n")
+    print(f"Total: {statistics.median(profile['total_ms'] for profile in profiles):.1f} ms\n")
+    print("| Imported by utils.py | Cumulative (ms) |")
+    print("|---|---|")
+    for name, cumulative_ms in profiles[len(profiles) // 2]["direct_imports"]:
+        if cumulative_ms >= 1:
+            print(f"| {name} | {cumulative_ms:.1f} |")
+
+    print(f"\n## First paint (median of {args.repeat} cold starts, network cut off)\n")
+    print("| App | First paint (ms) | Network calls | Exception |")
+    print("|---|---|---|---|")
+    for app in APPS:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--app", app],
+                                    cwd=ROOT, capture_output=True, text=True)
+            runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        median_ms = statistics.median(run["first_paint_ms"] for run in runs)
+        exception = runs[0]["exception"][0].splitlines()[0] if runs[0]["exception"] else ""
+        print(f"| {app} | {median_ms:.0f} | {len(runs[0]['network_calls'])} | {exception} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+cache.py
+"""
+import collections
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+# Which backend every cache uses: "memory" for an LRU cache in the process,
+# or "sqlite" for a store shared by every process on the machine
+CACHE_BACKEND = os.environ.get("DAVE_CACHE_BACKEND", "memory")
+CACHE_PATH = os.environ.get("DAVE_CACHE_PATH", "cache.db")
+# The most entries kept by the in-process LRU cache
+CACHE_MAX_ENTRIES = 1024
+# Seconds an entry is kept, per namespace
+CACHE_TTLS = {
+    "assistants": 60 * 60,
+    "uploaded_files": 60 * 60,
+    "guardrails": 24 * 60 * 60,
+    "images": 60 * 60,
+    "file_metadata": 30 * 60,
+}
+DEFAULT_TTL = 60 * 60
+
+
+class CacheBackend:
+    """
+    Where cached values are kept. Keys are strings, prefixed with their namespace.
+    Hits and misses are counted per namespace, in the process by default.
+    """
+    def __init__(self):
+        self._stats = collections.defaultdict(lambda: {"hits": 0, "misses": 0})
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Returns whether the key was found, and its value
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Keep a value for `ttl` seconds
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """
+        Forget a key
+        """
+        raise NotImplementedError
+
+    def record(self, namespace: str, hit: bool) -> None:
+        """
+        Count a hit or a miss in a namespace
+        """
+        with self._stats_lock:
+            self._stats[namespace]["hits" if hit else "misses"] += 1
+
+    def stats(self) -> dict:
+        """
+        The hit and miss counts of every namespace
+        """
+        with self._stats_lock:
+            return {namespace: dict(counts) for namespace, counts in self._stats.items()}
+
+
+class LRUCacheBackend(CacheBackend):
+    """
+    An LRU cache, only visible to the process it lives in
+    """
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    A cache kept in a SQLite file, which several processes can share safely.
+    Values are pickled, and expired entries are purged as new ones are written.
+    Hits and misses are counted in the file too, so they add up across processes.
+    """
+    def __init__(self, path: str = CACHE_PATH):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_by_expiry ON cache (expires_at);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                namespace TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        One connection per thread, waiting on the other processes' writes rather than failing
+        """
+        if getattr(self._local, "connection", None) is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        row = self._connection().execute("SELECT value FROM cache WHERE key = ? AND expires_at >= ?",
+                                         (key, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                           (key, pickle.dumps(value), now + ttl))
+        connection.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+
+    def delete(self, key: str) -> None:
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def record(self, namespace: str, hit: bool) -> None:
+        column = "hits" if hit else "misses"
+        self._connection().execute(f"""
+            INSERT INTO cache_stats (namespace, {column}) VALUES (?, 1)
+            ON CONFLICT (namespace) DO UPDATE SET {column} = {column} + 1
+            """, (namespace,))
+
+    def stats(self) -> dict:
+        rows = self._connection().execute("SELECT namespace, hits, misses FROM cache_stats").fetchall()
+        return {namespace: {"hits": hits, "misses": misses} for namespace, hits, misses in rows}
+
+
+class Cache:
+    """
+    A namespace of a cache backend, with its own TTL, whose hits and misses the backend counts
+    """
+    def __init__(self, namespace: str, backend: CacheBackend, ttl: float = DEFAULT_TTL):
+        self.namespace = namespace
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the cached value of the key, or the default
+        """
+        found, value = self.backend.get(f"{self.namespace}:{key}")
+        self.backend.record(self.namespace, found)
+        return value if found else default
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Cache the value of the key
+        """
+        self.backend.set(f"{self.namespace}:{key}", value, self.ttl)
+
+    def delete(self, key: str) -> None:
+        """
+        Forget the key
+        """
+        self.backend.delete(f"{self.namespace}:{key}")
+
+    def get_or_set(self, key: str, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of the key, computing and caching it on a miss
+        """
+        found, value = self.backend.get(f"{self.namespace}:{key}")
+        self.backend.record(self.namespace, found)
+        if found:
+            return value
+        value = compute()
+        self.set(key, value)
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache_backend(backend: str = CACHE_BACKEND) -> CacheBackend:
+    """
+    The backend shared by every cache of the process
+
+    Args:
+    - backend (str): "memory" or "sqlite"
+    """
+    if backend == "sqlite":
+        return SQLiteCacheBackend()
+    if backend == "memory":
+        return LRUCacheBackend()
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace: str, ttl: Optional[float] = None) -> Cache:
+    """
+    The cache of a namespace, on the configured backend
+
+    Args:
+    - namespace (str): The namespace, see `CACHE_TTLS`
+    - ttl (float): Seconds an entry is kept, defaults to the namespace's TTL
+    """
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = Cache(namespace,
+                                       get_cache_backend(),
+                                       ttl if ttl is not None else CACHE_TTLS.get(namespace, DEFAULT_TTL))
+        return _caches[namespace]
+
+
+def cache_stats() -> dict:
+    """
+    The hit and miss counts of every cache, of the process on the "memory" backend,
+    and of every process sharing the store on the "sqlite" backend
+    """
+    return get_cache_backend().stats()
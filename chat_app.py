@@ -1,23 +1,21 @@
 """
 chat_app.py
 """
-import base64
 import os
 
 import streamlit as st
-from openai import OpenAI
-from openai.types.beta.assistant_stream_event import (
-    ThreadRunStepCreated,
-    ThreadRunStepDelta,
-    ThreadRunStepCompleted,
-    ThreadMessageCreated,
-    ThreadMessageDelta
-    )
-from openai.types.beta.threads.text_delta_block import TextDeltaBlock 
-from openai.types.beta.threads.runs.tool_calls_step_details import ToolCallsStepDetails
-from openai.types.beta.threads.runs.code_interpreter_tool_call import (
-    CodeInterpreterOutputImage,
-    CodeInterpreterOutputLogs
+from context_window import ContextWindow, truncation_strategy
+from log_buffer import LogBuffer
+from stream_processor import StreamProcessor, TranscriptItem, TranscriptSink
+from transcript_store import get_transcript_store
+from utils import (
+    get_client,
+    get_session_key,
+    load_image_html,
+    moderation_endpoint,
+    normalize_uploads,
+    render_log,
+    upload_file
     )
 
 # Set page config
@@ -25,13 +23,9 @@ st.set_page_config(page_title="DAVE",
                    layout='wide')
 
 # Get secrets
-OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
+# The OpenAI client is only initialised on first use, so the first paint needs no network call
 ASSISTANT_ID = st.secrets["OPENAI_ASSISTANT_ID"]
 
-# Initialise the OpenAI client, and retrieve the assistant
-client = OpenAI(api_key=OPENAI_API_KEY)
-assistant = client.beta.assistants.retrieve(ASSISTANT_ID)
-
 # Apply custom CSS
 st.html("""
         <style>
@@ -47,24 +41,106 @@ st.html("""
         </style>
         """)
 
-# Initialise session state
-for session_state_var in ["file_uploaded"]:
-    if session_state_var not in st.session_state:
-        st.session_state[session_state_var] = False
+# Stored transcript
+def stored_content(item: dict):
+    """
+    The content of a transcript item, as it is stored: logs are stored as their head and tail,
+    and images as the ids of their files saved under `images/`
+    """
+    if item["type"] == "code_output":
+        return item["content"].to_dict()
+    if item["type"] == "image":
+        return item["file_ids"]
+    return item["content"]
 
-# Moderation check
-def moderation_endpoint(text) -> bool:
+def restored_item(item: dict) -> dict:
     """
-    Checks if the text is triggers the moderation endpoint
+    A transcript item, as loaded from the store
+    """
+    if item["type"] == "code_output":
+        return {**item, "content": LogBuffer.from_dict(item["content"])}
+    if item["type"] == "image":
+        file_ids = [file_id for file_id in item["content"] if os.path.exists(f"images/{file_id}.png")]
+        return {**item, "content": [load_image_html(file_id) for file_id in file_ids], "file_ids": file_ids}
+    return item
+
+def persist_item(turn: int, role: str, item: dict) -> None:
+    """
+    Write a new transcript item to the store, as soon as it is created
+    """
+    item["id"] = transcript_store.append_item(session_key, turn, len(turn_items), role, item["type"], stored_content(item))
+    turn_items.append(item)
 
-    Args:
-    - text (str): The text to check
+class ChatSink(TranscriptSink):
+    """
+    Draws the answer in the chat as it streams, and keeps its transcript items in the store
 
-    Returns:
-    - bool: True if the text is flagged
+    Args:
+    - turn (int): The index of the answer in the session
     """
-    response = client.moderations.create(input=text)
-    return response.results[0].flagged
+    def __init__(self, turn: int):
+        self.turn = turn
+        self.chat_items = {}
+        self.placeholders = {}
+        self.code_expanders = {}
+
+    def on_item_created(self, item: TranscriptItem) -> None:
+        if item.type == "text":
+            chat_item = {"type": "text", "content": ""}
+            self.placeholders[item.key] = st.empty()
+        elif item.type == "code_input":
+            chat_item = {"type": "code_input", "content": ""}
+            self.code_expanders[item.key] = st.status("Writing code ⏳ ...", expanded=True)
+            self.placeholders[item.key] = self.code_expanders[item.key].empty()
+        elif item.type == "code_output":
+            # Only the head and tail of big logs are kept, the full log is saved to a file
+            chat_item = {"type": "code_output", "content": LogBuffer(item.name)}
+            self.placeholders[item.key] = st.status("Results", state="complete").empty()
+        else:
+            # Download, save and encode the image, unless it is cached
+            image_html = load_image_html(item.file_id)
+            chat_item = {"type": "image", "content": [image_html], "file_ids": [item.file_id]}
+            st.html(image_html)
+        self.chat_items[item.key] = chat_item
+        persist_item(self.turn, "assistant", chat_item)
+
+    def on_item_delta(self, item: TranscriptItem, delta: str) -> None:
+        chat_item = self.chat_items[item.key]
+        if item.type == "text":
+            chat_item["content"] = item.content
+            self.placeholders[item.key].markdown(chat_item["content"])
+        elif item.type == "code_input":
+            chat_item["content"] = item.content
+            self.placeholders[item.key].code(chat_item["content"])
+        elif item.type == "code_output":
+            chat_item["content"].append(delta)
+            render_log(self.placeholders[item.key].container(), chat_item["content"])
+
+    def on_item_done(self, item: TranscriptItem) -> None:
+        chat_item = self.chat_items[item.key]
+        if item.type == "code_input":
+            self.code_expanders[item.key].update(label="Code", state="complete", expanded=False)
+        if item.type in ["text", "code_input", "code_output"]:
+            transcript_store.update_item(chat_item["id"], stored_content(chat_item))
+
+# Reload the session from the transcript store, without any API call
+session_key = get_session_key()
+transcript_store = get_transcript_store()
+if "messages" not in st.session_state:
+    saved_session = transcript_store.load_session(session_key)
+    if saved_session is not None:
+        st.session_state.thread_id = saved_session["thread_id"]
+        st.session_state.file_id = saved_session["file_ids"]
+        st.session_state.file_uploaded = True
+        st.session_state.context_window = ContextWindow(saved_session["context_turn"], saved_session["recap"])
+        st.session_state.messages = [{"role": message["role"],
+                                      "items": [restored_item(item) for item in message["items"]]}
+                                     for message in transcript_store.load_messages(session_key)]
+
+# Initialise session state
+for session_state_var in ["file_uploaded"]:
+    if session_state_var not in st.session_state:
+        st.session_state[session_state_var] = False
 
 # UI
 st.subheader("🔮 DAVE: Data Analysis & Visualisation Engine")
@@ -80,18 +156,18 @@ if not st.session_state["file_uploaded"]:
 
     if upload_btn.button("Upload"):
 
+        # Validate and normalize the file(s) locally, so a bad file fails before any upload
+        normalized_files = normalize_uploads(st.session_state["files"])
+        if normalized_files is None:
+            st.stop()
+
         st.session_state["file_id"] = []
 
         # Upload the file
-        for file in st.session_state["files"]:
-            oai_file = client.files.create(
-                file=file,
-                purpose='assistants'
-            )
-
+        for file_name, file, _ in normalized_files:
             # Append the file ID to the list
-            st.session_state["file_id"].append(oai_file.id)
-            print(f"Uploaded new file: \t {oai_file.id}")
+            st.session_state["file_id"].append(upload_file(file, file_name))
+            file.close()
 
         st.toast("File(s) uploaded successfully", icon="🚀")
         st.session_state["file_uploaded"] = True
@@ -102,22 +178,23 @@ if not st.session_state["file_uploaded"]:
 
 if st.session_state["file_uploaded"]:
 
-    # Create a new thread
+    # Create a new thread, with the file(s) attached
     if "thread_id" not in st.session_state:
-        thread = client.beta.threads.create()
-        st.session_state.thread_id = thread.id
-        print(st.session_state.thread_id)
-
-    # Update the thread to attach the file
-    client.beta.threads.update(
-            thread_id=st.session_state.thread_id,
+        thread = get_client().beta.threads.create(
             tool_resources={"code_interpreter": {"file_ids": [file_id for file_id in st.session_state.file_id]}}
             )
+        st.session_state.thread_id = thread.id
+        print(st.session_state.thread_id)
+        transcript_store.save_session(session_key, st.session_state.thread_id, st.session_state.file_id)
 
     # Local history
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
+    # The part of the history in the thread
+    if "context_window" not in st.session_state:
+        st.session_state.context_window = ContextWindow()
+
     # UI
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
@@ -133,20 +210,31 @@ if st.session_state["file_uploaded"]:
                         st.code(item["content"])
                 elif item_type == "code_output":
                     with st.status("Results", state="complete"):
-                        st.code(item["content"])
+                        render_log(st, item["content"])
 
     if prompt := st.chat_input("Ask me a question about your dataset"):
         if moderation_endpoint(prompt):
             st.toast("Your message was flagged. Please try again.", icon="⚠️")
             st.stop
 
+        # Compact a long conversation into a recap, in a fresh thread, before it slows every turn down
+        context_window = st.session_state.context_window
+        if context_window.needs_compaction(st.session_state.messages):
+            with st.spinner("Summarising the earlier conversation..."):
+                st.session_state.thread_id = context_window.compact(st.session_state.thread_id,
+                                                                    st.session_state.messages,
+                                                                    st.session_state.file_id)
+            transcript_store.save_context(session_key,
+                                          st.session_state.thread_id,
+                                          context_window.start_turn,
+                                          context_window.recap)
+
+        turn_items = []
+        persist_item(len(st.session_state.messages), "user", {"type": "text", "content": prompt})
         st.session_state.messages.append({"role": "user",
-                                        "items": [
-                                            {"type": "text", 
-                                            "content": prompt
-                                            }]})
+                                        "items": turn_items})
         
-        client.beta.threads.messages.create(
+        get_client().beta.threads.messages.create(
             thread_id=st.session_state.thread_id,
             role="user",
             content=prompt
@@ -156,84 +244,26 @@ if st.session_state["file_uploaded"]:
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            stream = client.beta.threads.runs.create(
+            stream = get_client().beta.threads.runs.create(
                 thread_id=st.session_state.thread_id,
                 assistant_id=ASSISTANT_ID,
                 tool_choice={"type": "code_interpreter"},
+                truncation_strategy=truncation_strategy(),
                 stream=True
             )
 
-            assistant_output = []
-
-            for event in stream:
-                print(event)
-                if isinstance(event, ThreadRunStepCreated):
-                    if event.data.step_details.type == "tool_calls":
-                        assistant_output.append({"type": "code_input",
-                                                "content": ""})
-
-                        code_input_expander= st.status("Writing code ⏳ ...", expanded=True)
-                        code_input_block = code_input_expander.empty()
-
-                if isinstance(event, ThreadRunStepDelta):
-                    if event.data.delta.step_details.tool_calls[0].code_interpreter is not None:
-                        code_interpretor = event.data.delta.step_details.tool_calls[0].code_interpreter
-                        code_input_delta = code_interpretor.input
-                        if (code_input_delta is not None) and (code_input_delta != ""):
-                            assistant_output[-1]["content"] += code_input_delta
-                            code_input_block.empty()
-                            code_input_block.code(assistant_output[-1]["content"])
-
-                elif isinstance(event, ThreadRunStepCompleted):
-                    if isinstance(event.data.step_details, ToolCallsStepDetails):
-                        code_interpretor = event.data.step_details.tool_calls[0].code_interpreter
-                        if code_interpretor.outputs is not None:
-                            code_interpretor_outputs = code_interpretor.outputs[0]
-                            code_input_expander.update(label="Code", state="complete", expanded=False)
-                            # Image
-                            if isinstance(code_interpretor_outputs, CodeInterpreterOutputImage):
-                                image_html_list = []
-                                for output in code_interpretor.outputs:
-                                    image_file_id = output.image.file_id
-                                    image_data = client.files.content(image_file_id)
-                                    
-                                    # Save file
-                                    image_data_bytes = image_data.read()
-                                    with open(f"images/{image_file_id}.png", "wb") as file:
-                                        file.write(image_data_bytes)
-
-                                    # Open file and encode as data
-                                    file_ = open(f"images/{image_file_id}.png", "rb")
-                                    contents = file_.read()
-                                    data_url = base64.b64encode(contents).decode("utf-8")
-                                    file_.close()
-
-                                    # Display image
-                                    image_html = f'<p align="center"><img src="data:image/png;base64,{data_url}" width=600></p>'
-                                    st.html(image_html)
-
-                                    image_html_list.append(image_html)
-
-                                assistant_output.append({"type": "image",
-                                                        "content": image_html_list})
-                            # Console log
-                            elif isinstance(code_interpretor_outputs, CodeInterpreterOutputLogs):
-                                assistant_output.append({"type": "code_output",
-                                                         "content": ""})
-                                code_output = code_interpretor.outputs[0].logs
-                                with st.status("Results", state="complete"):
-                                    st.code(code_output)    
-                                    assistant_output[-1]["content"] = code_output   
-
-                elif isinstance(event, ThreadMessageCreated):
-                    assistant_output.append({"type": "text",
-                                            "content": ""})
-                    assistant_text_box = st.empty()
-
-                elif isinstance(event, ThreadMessageDelta):
-                    if isinstance(event.data.delta.content[0], TextDeltaBlock):
-                        assistant_text_box.empty()
-                        assistant_output[-1]["content"] += event.data.delta.content[0].text.value
-                        assistant_text_box.markdown(assistant_output[-1]["content"])
-                
-            st.session_state.messages.append({"role": "assistant", "items": assistant_output})
+            # Every item is written to the transcript store as soon as it is created
+            turn = len(st.session_state.messages)
+            assistant_output = turn_items = []
+            processor = StreamProcessor(ChatSink(turn))
+            try:
+                processor.process_all(stream)
+            finally:
+                # Write the text and code as completed, even if the stream was cut short, and keep
+                # the answer in the history, so that the next question does not reuse its turn
+                for item in assistant_output:
+                    if item["type"] in ["text", "code_input"]:
+                        transcript_store.update_item(item["id"], item["content"])
+                st.session_state.messages.append({"role": "assistant", "items": assistant_output})
+            if processor.run is not None and processor.run.usage is not None:
+                print(f"Prompt tokens: \t {processor.run.usage.prompt_tokens}")
@@ -0,0 +1,150 @@
+"""
+context_window.py
+"""
+from typing import Optional
+
+from utils import delete_thread, get_client
+
+# Config
+# A rough count of characters per token, enough to tell when a thread grows too big
+CHARS_PER_TOKEN = 4
+# A thread estimated past this many tokens is compacted before the next question
+COMPACTION_THRESHOLD = 12000
+# Runs only read the last messages of their thread, so the prompt of a turn stays bounded
+TRUNCATION_LAST_MESSAGES = 16
+# The messages kept free in the window for the next question and its answer
+COMPACTION_MESSAGE_MARGIN = 4
+# The most characters of each code input and output the recap is written from
+RECAP_CODE_CHARS = 1500
+RECAP_OUTPUT_CHARS = 1500
+RECAP_MODEL = "gpt-3.5-turbo"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    The approximate number of tokens of a text
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def item_tokens(item: dict) -> int:
+    """
+    The approximate number of tokens a chat item adds to the thread, code outputs included in full
+    """
+    if item["type"] in ["text", "code_input"]:
+        return estimate_tokens(item["content"])
+    if item["type"] == "code_output":
+        return item["content"].total_bytes // CHARS_PER_TOKEN + 1
+    return 0
+
+
+def truncation_strategy() -> dict:
+    """
+    The truncation strategy to start every run with
+    """
+    return {"type": "last_messages", "last_messages": TRUNCATION_LAST_MESSAGES}
+
+
+def turn_text(message: dict) -> str:
+    """
+    A chat message as plain text, with its code and outputs clipped, to write a recap from
+    """
+    parts = []
+    for item in message["items"]:
+        if item["type"] == "text":
+            parts.append(item["content"])
+        elif item["type"] == "code_input":
+            parts.append(f"[Code]\n{item['content'][:RECAP_CODE_CHARS]}")
+        elif item["type"] == "code_output":
+            parts.append(f"[Output]\n{item['content'].render()[-RECAP_OUTPUT_CHARS:]}")
+        elif item["type"] == "image":
+            parts.append("[Chart]")
+    return f"{message['role'].capitalize()}: " + "\n".join(parts)
+
+
+def summarize_turns(recap: Optional[str], messages: list[dict]) -> str:
+    """
+    Writes a compact recap of a conversation
+
+    Args:
+    - recap (str): The recap of the turns before, if any
+    - messages (list[dict]): The turns to add to the recap
+
+    Returns:
+    - str: The recap
+    """
+    conversation = "\n\n".join(turn_text(message) for message in messages)
+    if recap:
+        conversation = f"Recap of the earlier conversation: {recap}\n\n{conversation}"
+    response = get_client().chat.completions.create(
+        model=RECAP_MODEL,
+        messages=[
+            {"role": "system", "content": "You are given a data analysis conversation between a user and an assistant that runs code on the user's dataset(s). Write a compact recap of it, to continue the conversation from: the questions asked, the findings with their key numbers, and the facts learnt about the dataset(s), such as file and column names, cleaning steps and charts made. Leave out the code itself. Do not use markdown headers."},
+            {"role": "user", "content": conversation},
+        ],
+        temperature=0,
+    )
+    return response.choices[0].message.content
+
+
+class ContextWindow:
+    """
+    Tracks the approximate token footprint of a chat thread, which holds the turns from `start_turn` on,
+    after a recap of the turns before. Past a threshold, the thread is compacted: the turns are summarized
+    into the recap, and a fresh thread is started with the recap and the same files.
+
+    Args:
+    - start_turn (int): The index of the first message in the thread
+    - recap (str): The recap the thread starts with, if any
+    """
+    def __init__(self, start_turn: int = 0, recap: Optional[str] = None):
+        self.start_turn = start_turn
+        self.recap = recap
+
+    def footprint(self, messages: list[dict]) -> int:
+        """
+        The approximate number of tokens in the thread
+        """
+        tokens = estimate_tokens(self.recap) if self.recap else 0
+        return tokens + sum(item_tokens(item) for message in messages[self.start_turn:] for item in message["items"])
+
+    def thread_messages(self, messages: list[dict]) -> int:
+        """
+        The approximate number of messages in the thread, as an answer may span several messages
+        """
+        return (1 if self.recap else 0) + sum(max(1, sum(item["type"] == "text" for item in message["items"]))
+                                              for message in messages[self.start_turn:])
+
+    def needs_compaction(self, messages: list[dict]) -> bool:
+        """
+        Whether to compact the thread before the next question: when it is too big, or when the next
+        question and answer could push the oldest messages out of those runs read, unsummarized
+        """
+        if len(messages) <= self.start_turn:
+            return False
+        return (self.footprint(messages) > COMPACTION_THRESHOLD
+                or self.thread_messages(messages) + COMPACTION_MESSAGE_MARGIN > TRUNCATION_LAST_MESSAGES)
+
+    def compact(self, thread_id: str, messages: list[dict], file_ids: list[str]) -> str:
+        """
+        Summarize the turns of the thread into the recap, start a fresh thread seeded with it and
+        with the same files, and delete the old thread
+
+        Args:
+        - thread_id (str): The thread to compact
+        - messages (list[dict]): Every message of the session
+        - file_ids (list[str]): The files attached to the thread
+
+        Returns:
+        - str: The id of the new thread
+        """
+        tokens = self.footprint(messages)
+        self.recap = summarize_turns(self.recap, messages[self.start_turn:])
+        self.start_turn = len(messages)
+        thread = get_client().beta.threads.create(
+            messages=[{"role": "assistant", "content": f"Recap of our conversation so far:\n\n{self.recap}"}],
+            tool_resources={"code_interpreter": {"file_ids": file_ids}}
+            )
+        print(f"Compacted thread: \t {thread_id} -> {thread.id} (~{tokens:,} -> ~{self.footprint(messages):,} tokens)")
+        delete_thread(thread_id)
+        return thread.id
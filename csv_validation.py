@@ -0,0 +1,159 @@
+"""
+csv_validation.py
+"""
+import codecs
+import csv
+import io
+import tempfile
+from typing import Iterator, Tuple
+
+# Size of the chunks the file is read in
+CSV_CHUNK_SIZE = 1024 * 1024
+# Normalized files are kept in memory up to this size, then spooled to disk
+CSV_SPOOL_SIZE = 16 * 1024 * 1024
+# Delimiters the sniffer chooses from
+CSV_DELIMITERS = ",;\t|"
+# Used when the file is not valid UTF-8, as it decodes most bytes (all but 0x81, 0x8D, 0x8F, 0x90 and 0x9D)
+FALLBACK_ENCODING = "cp1252"
+# Byte order marks, and the encoding they identify
+BOMS = [(codecs.BOM_UTF8, "utf-8-sig"),
+        (codecs.BOM_UTF16_LE, "utf-16"),
+        (codecs.BOM_UTF16_BE, "utf-16")]
+
+
+class CSVValidationError(ValueError):
+    """
+    Raised when a file is not a well-formed CSV file
+    """
+
+
+def sniff_encoding(head: bytes) -> str:
+    """
+    Guesses the encoding of a file from its first chunk
+
+    Args:
+    - head (bytes): The first chunk of the file
+
+    Returns:
+    - str: The encoding
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    try:
+        # The chunk may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
+def sniff_delimiter(sample: str) -> str:
+    """
+    Guesses the delimiter of a CSV file from its first lines, defaulting to a comma
+    """
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        return ","
+
+
+def decoded_lines(file, head: bytes, encoding: str, report: dict) -> Iterator[str]:
+    """
+    Decodes a file chunk by chunk, and yields its lines with their line endings.
+    A UTF-8 file which turns out not to be is decoded with the fallback encoding from then on,
+    which is only safe while every byte so far was ASCII.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    ascii_so_far = True
+    offset = 0
+    pending = ""
+    chunk = head
+    while True:
+        final = not chunk
+        try:
+            text = decoder.decode(chunk, final=final)
+        except UnicodeDecodeError as exc:
+            if encoding != "utf-8" or not ascii_so_far:
+                raise CSVValidationError(f"The file is not valid {encoding}, from byte {offset + exc.start:,}") from exc
+            encoding = report["encoding"] = FALLBACK_ENCODING
+            decoder = codecs.getincrementaldecoder(encoding)()
+            try:
+                text = decoder.decode(chunk, final=final)
+            except UnicodeDecodeError as fallback_exc:
+                raise CSVValidationError(f"The file is neither valid UTF-8 nor {encoding}, "
+                                         f"from byte {offset + fallback_exc.start:,}") from fallback_exc
+        ascii_so_far = ascii_so_far and chunk.isascii()
+        offset += len(chunk)
+
+        # Only whole lines are handed over, the last one may continue in the next chunk
+        lines = list(io.StringIO(pending + text, newline=""))
+        pending = lines.pop() if lines and not final and not lines[-1].endswith(("\n", "\r")) else ""
+        yield from lines
+        if final:
+            return
+        chunk = file.read(CSV_CHUNK_SIZE)
+
+
+def normalize_csv(file) -> Tuple[tempfile.SpooledTemporaryFile, dict]:
+    """
+    Validates a CSV file and rewrites it as UTF-8 with comma delimiters, in a single streaming pass.
+    Sniffs the encoding and the delimiter from the first chunk, and checks that every row has as many
+    columns as the header, failing on the first row which does not.
+
+    Args:
+    - file (UploadedFile): The CSV file
+
+    Returns:
+    - SpooledTemporaryFile: The normalized file, rewound
+    - dict: What was found: the encoding, the delimiter, the columns and the number of rows
+
+    Raises:
+    - CSVValidationError: If the file is empty, is not text, or has rows of the wrong length
+    """
+    file.seek(0)
+    head = file.read(CSV_CHUNK_SIZE)
+    if not head.strip():
+        raise CSVValidationError("The file is empty")
+    if b"\x00" in head and not head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raise CSVValidationError("The file is not a text file")
+
+    encoding = sniff_encoding(head)
+    report = {"encoding": encoding}
+    sample = head[:64 * 1024].decode(encoding, errors="ignore")
+    report["delimiter"] = sniff_delimiter(sample)
+
+    normalized = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE, mode="w+b")
+    text = codecs.getwriter("utf-8")(normalized)
+    writer = csv.writer(text, lineterminator="\n")
+    try:
+        reader = csv.reader(decoded_lines(file, head, encoding, report), delimiter=report["delimiter"], strict=True)
+        header = next(reader, [])
+        if not any(column.strip() for column in header):
+            raise CSVValidationError("The file has no header row")
+        writer.writerow(header)
+
+        rows = 0
+        for row in reader:
+            # Blank lines are dropped
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise CSVValidationError(f"Line {reader.line_num:,} has {len(row)} column(s), "
+                                         f"but the header has {len(header)}")
+            writer.writerow(row)
+            rows += 1
+    except csv.Error as exc:
+        normalized.close()
+        raise CSVValidationError(f"Line {reader.line_num:,} is malformed: {exc}") from exc
+    except CSVValidationError:
+        normalized.close()
+        raise
+    finally:
+        # Hand the file back rewound
+        file.seek(0)
+
+    normalized.seek(0)
+    report["columns"] = header
+    report["rows"] = rows
+    return normalized, report
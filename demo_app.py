@@ -1,25 +1,31 @@
 """
 demo_app.py
 """
-import os
 import streamlit as st
-from openai import OpenAI
 from utils import (
-    delete_files,
+    clean_up_abandoned_run,
+    delete_downloads,
     delete_thread,
-    EventHandler,
+    DOWNLOAD_TTL,
+    get_client,
+    get_session_key,
     moderation_endpoint,
     is_nsfw,
     # is_not_question,
     render_custom_css,
     render_download_files,
+    render_run_progress,
     retrieve_messages_from_thread,
-    retrieve_assistant_created_files
+    retrieve_assistant_created_files,
+    RUN_BUDGET
     )
+from log_buffer import delete_logs
+from run_registry import run_registry, RunBudget
+from stream_processor import StreamProcessor
+from streamlit_sink import StreamlitSink
 
-# Initialise the OpenAI client, and retrieve the assistant
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-assistant = client.beta.assistants.retrieve(st.secrets["ASSISTANT_ID"])
+# The OpenAI client is only initialised on first use, so the first paint needs no network call
+ASSISTANT_ID = st.secrets["ASSISTANT_ID"]
 
 st.set_page_config(page_title="DAVE",
                    page_icon="🕵️")
@@ -31,82 +37,117 @@ render_custom_css()
 if "file_uploaded" not in st.session_state:
     st.session_state.file_uploaded = False
 
-if "assistant_text" not in st.session_state:
-    st.session_state.assistant_text = [""]
-
-if "code_input" not in st.session_state:
-    st.session_state.code_input = []
-
-if "code_output" not in st.session_state:
-    st.session_state.code_output = []
-
 if "disabled" not in st.session_state:
     st.session_state.disabled = False
 
+# Reattach to a run still in flight for this browser session, e.g. after a rerun or a reconnect
+session_key = get_session_key()
+live_run = run_registry.get(session_key)
+if live_run is not None:
+    st.session_state.thread_id = live_run.thread_id
+
 # UI
 st.subheader("🔮 DAVE: Data Analysis & Visualisation Engine")
 st.markdown("This demo uses a data.gov.sg dataset on HDB resale prices.", help="[Source](https://beta.data.gov.sg/collections/189/datasets/d_ebc5ab87086db484f88045b47411ebc5/view)")
 text_box = st.empty()
 qn_btn = st.empty()
-
-question = text_box.text_area("Ask a question", disabled=st.session_state.disabled)
-if qn_btn.button("Ask DAVE"):
+stop_btn = st.empty()
+progress_box = st.empty()
+
+if live_run is None:
+    question = text_box.text_area("Ask a question", disabled=st.session_state.disabled)
+    if qn_btn.button("Ask DAVE"):
+
+        if moderation_endpoint(question):
+            text_box.empty()
+            qn_btn.empty()
+            st.warning("Your question has been flagged. Refresh page to try again.")
+            st.stop()
+
+        # if is_not_question(question):
+        #     st.warning("Please ask a question. Refresh page to try again.")
+        #     client.beta.threads.delete(st.session_state.thread_id)
+        #     st.stop()
+
+        # Create a new thread
+        if "thread_id" not in st.session_state:
+            thread = get_client().beta.threads.create()
+            st.session_state.thread_id = thread.id
+            print(st.session_state.thread_id)
+
+        # Update the thread to attach the file
+        get_client().beta.threads.update(
+                thread_id=st.session_state.thread_id,
+                tool_resources={"code_interpreter": {"file_ids": [st.secrets["FILE_ID"]]}}
+                )
+
+        get_client().beta.threads.messages.create(
+            thread_id=st.session_state.thread_id,
+            role="user",
+            content=question
+        )
+
+        live_run = run_registry.start(get_client(),
+                                      session_key,
+                                      st.session_state.thread_id,
+                                      context={"question": question},
+                                      budget=RunBudget(**RUN_BUDGET),
+                                      cleanup=clean_up_abandoned_run,
+                                      assistant_id=ASSISTANT_ID,
+                                      tool_choice={"type": "code_interpreter"},
+                                      temperature=0)
+
+if live_run is not None:
 
     text_box.empty()
     qn_btn.empty()
 
-    if moderation_endpoint(question):
-        st.warning("Your question has been flagged. Refresh page to try again.")
-        st.stop()
-
-    # if is_not_question(question):
-    #     st.warning("Please ask a question. Refresh page to try again.")
-    #     client.beta.threads.delete(st.session_state.thread_id)
-    #     st.stop()
-
-    # Create a new thread
-    if "thread_id" not in st.session_state:
-        thread = client.beta.threads.create()
-        st.session_state.thread_id = thread.id
-        print(st.session_state.thread_id)
+    # The transcript is drawn afresh on every (re)run
+    st.session_state.text_boxes = []
 
-    # Update the thread to attach the file
-    client.beta.threads.update(
-            thread_id=st.session_state.thread_id,
-            tool_resources={"code_interpreter": {"file_ids": [st.secrets["FILE_ID"]]}}
-            )
-
-    if "text_boxes" not in st.session_state:
-        st.session_state.text_boxes = []
-        
-    client.beta.threads.messages.create(
-        thread_id=st.session_state.thread_id,
-        role="user",
-        content=question
-    )
+    # The Stop button reruns the script, which reattaches to the run and stops it
+    if stop_btn.button("⏹️ Stop", key="stop_run"):
+        live_run.stop("Stopped by the user")
 
     st.session_state.text_boxes.append(st.empty())
-    st.session_state.text_boxes[-1].success(f"**> 🤔 User:** {question}")
-
-    with client.beta.threads.runs.stream(thread_id=st.session_state.thread_id,
-                                          assistant_id=assistant.id,
-                                          tool_choice={"type": "code_interpreter"},
-                                          event_handler=EventHandler(),
-                                          temperature=0) as stream:
-        stream.until_done()
+    st.session_state.text_boxes[-1].success(f"**> 🤔 User:** {live_run.context['question']}")
+
+    # A run whose stream failed is reported, and cleaned up like the others
+    run_error = None
+    try:
+        run_registry.follow(live_run,
+                            StreamProcessor(StreamlitSink()),
+                            on_progress=lambda followed_runs: render_run_progress(progress_box, followed_runs))
+    except Exception as exc:
+        run_error = exc
+        # The error may come from drawing the run rather than from its stream: stop the run if it still runs,
+        # as it is released below, out of reach of the budget and orphan checks
+        if not live_run.done:
+            live_run.stop("Stopped after an error")
+    stop_btn.empty()
+
+    st.session_state.assistant_created_file_ids = []
+    if run_error is not None:
+        st.error(f"DAVE could not finish analysing the data ({run_error}). Please try again.")
+    else:
+        if live_run.stop_reason is not None:
+            st.warning(f"⏹️ {live_run.stop_reason}: the analysis was stopped, and only what was done so far is shown.")
         st.toast("DAVE has finished analysing the data", icon="🕵️")
 
-    # Prepare the files for download
-    with st.spinner("Preparing the files for download..."):
-        # Retrieve the messages by the Assistant from the thread
-        assistant_messages = retrieve_messages_from_thread(st.session_state.thread_id)
-        # For each assistant message, retrieve the file(s) created by the Assistant
-        st.session_state.assistant_created_file_ids = retrieve_assistant_created_files(assistant_messages)
-        # Download these files
-        st.session_state.download_files, st.session_state.download_file_names = render_download_files(st.session_state.assistant_created_file_ids)
+        # Prepare the files for download
+        with st.spinner("Preparing the files for download..."):
+            # Retrieve the messages by the Assistant from the thread
+            assistant_messages = retrieve_messages_from_thread(st.session_state.thread_id)
+            # For each assistant message, retrieve the file(s) created by the Assistant
+            st.session_state.assistant_created_file_ids = retrieve_assistant_created_files(assistant_messages)
+            # Render the download buttons, the files are only fetched when clicked
+            render_download_files(st.session_state.assistant_created_file_ids)
 
     # Clean-up
-    # Delete the file(s) created by the Assistant
-    delete_files(st.session_state.assistant_created_file_ids)
+    run_registry.release(live_run)
+    # Delete the file(s) created by the Assistant, once the user has had the time to download them
+    run_registry.defer(DOWNLOAD_TTL, delete_downloads, st.session_state.assistant_created_file_ids)
     # Delete the thread
     delete_thread(st.session_state.thread_id)
+    # Delete the full logs, once the user has had the time to open them
+    run_registry.defer(DOWNLOAD_TTL, delete_logs, [st.session_state.thread_id])
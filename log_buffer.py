@@ -0,0 +1,123 @@
+"""
+log_buffer.py
+"""
+import collections
+import glob
+import os
+
+# Where the full logs are saved, served by Streamlit's static file serving
+LOG_DIR = "static/logs"
+LOG_URL = "app/static/logs"
+# The most bytes of a log kept in memory and rendered, half for its head and half for its tail
+LOG_BUDGET = 64 * 1024
+
+
+class LogBuffer:
+    """
+    Keeps the head and the tail of a log within a byte budget, while the full log is
+    written to a file which can be loaded on demand
+    """
+    def __init__(self, name: str, budget: int = LOG_BUDGET):
+        self.name = name
+        self.path = os.path.join(LOG_DIR, f"{name}.txt")
+        self.url = f"{LOG_URL}/{name}.txt"
+        self.head = ""
+        self.head_bytes = 0
+        # Once a byte has gone to the tail, the head takes no more, or the log would be out of order
+        self.head_closed = False
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.total_bytes = 0
+        self._half_budget = budget // 2
+        os.makedirs(LOG_DIR, exist_ok=True)
+        # Truncate whatever an earlier replay of the same output wrote
+        open(self.path, "w", encoding="utf-8").close()
+
+    @property
+    def truncated(self) -> bool:
+        """
+        Whether part of the log is left out of the buffer
+        """
+        return self.total_bytes > self.head_bytes + self.tail_bytes
+
+    def append(self, text: str) -> None:
+        """
+        Append text to the log
+        """
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(text)
+        data = text.encode("utf-8")
+        self.total_bytes += len(data)
+
+        # Fill up the head first, which may end short of its budget, before a character cut in two
+        if not self.head_closed:
+            head = data[:self._half_budget - self.head_bytes].decode("utf-8", errors="ignore")
+            self.head += head
+            self.head_bytes += len(head.encode("utf-8"))
+            data = data[len(head.encode("utf-8")):]
+            if not data:
+                return
+            self.head_closed = True
+
+        # Then keep the last bytes in the tail, dropping the oldest chunks
+        data = data[-self._half_budget:]
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+        while self.tail_bytes - len(self.tail[0]) >= self._half_budget:
+            self.tail_bytes -= len(self.tail.popleft())
+        if self.tail_bytes > self._half_budget:
+            excess = self.tail_bytes - self._half_budget
+            self.tail[0] = self.tail[0][excess:]
+            self.tail_bytes -= excess
+
+    def render(self) -> str:
+        """
+        The head and the tail of the log, with a marker where bytes were left out
+        """
+        tail = b"".join(self.tail).decode("utf-8", errors="ignore")
+        if not self.truncated:
+            return self.head + tail
+        skipped_bytes = self.total_bytes - self.head_bytes - self.tail_bytes
+        return f"{self.head}\n\n[... {skipped_bytes:,} bytes truncated, open the full log to see them ...]\n\n{tail}"
+
+    def to_dict(self) -> dict:
+        """
+        The buffered part of the log, e.g. to store it
+        """
+        return {"name": self.name,
+                "head": self.head,
+                "tail": b"".join(self.tail).decode("utf-8", errors="ignore"),
+                "total_bytes": self.total_bytes}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LogBuffer":
+        """
+        Restore a buffer from `to_dict`, leaving its full log file as it is
+        """
+        log_buffer = cls.__new__(cls)
+        log_buffer.name = data["name"]
+        log_buffer.path = os.path.join(LOG_DIR, f"{data['name']}.txt")
+        log_buffer.url = f"{LOG_URL}/{data['name']}.txt"
+        log_buffer.head = data["head"]
+        log_buffer.head_bytes = len(data["head"].encode("utf-8"))
+        log_buffer.tail = collections.deque([data["tail"].encode("utf-8")])
+        log_buffer.tail_bytes = len(log_buffer.tail[0])
+        log_buffer.total_bytes = data["total_bytes"]
+        log_buffer.head_closed = log_buffer.total_bytes > log_buffer.head_bytes
+        log_buffer._half_budget = max(log_buffer.head_bytes, log_buffer.tail_bytes)
+        return log_buffer
+
+    def __str__(self) -> str:
+        return self.render()
+
+
+def delete_logs(thread_id_list: list[str]) -> None:
+    """
+    Delete the full logs of the threads
+
+    Args:
+    - thread_id_list (list[str]): List of thread ids, which prefix the names of their logs
+    """
+    for thread_id in thread_id_list:
+        for path in glob.glob(os.path.join(LOG_DIR, f"{thread_id}_*.txt")):
+            os.remove(path)
@@ -0,0 +1,373 @@
+"""
+run_registry.py
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+# Seconds a live run may go without a script following it before it is cancelled
+RUN_GRACE_PERIOD = 120
+# Seconds a finished run is kept around for a late reattach before it is dropped
+FINISHED_RUN_TTL = 600
+# Seconds between two sweeps of the reaper
+REAPER_INTERVAL = 2
+
+
+@dataclass
+class RunBudget:
+    """
+    Limits on a single run. The token limits are also enforced by OpenAI, the others are
+    enforced here by cancelling the run. `None` means no limit.
+    """
+    max_seconds: Optional[float] = None
+    max_prompt_tokens: Optional[int] = None
+    max_completion_tokens: Optional[int] = None
+    max_tool_calls: Optional[int] = None
+
+    def run_kwargs(self) -> dict:
+        """
+        The token limits, as arguments to `client.beta.threads.runs.create`
+        """
+        run_kwargs = {}
+        if self.max_prompt_tokens is not None:
+            run_kwargs["max_prompt_tokens"] = self.max_prompt_tokens
+        if self.max_completion_tokens is not None:
+            run_kwargs["max_completion_tokens"] = self.max_completion_tokens
+        return run_kwargs
+
+    def exceeded(self, usage: dict) -> Optional[str]:
+        """
+        Returns the reason the usage exceeds the budget, if it does
+        """
+        for limit, used, what in [(self.max_seconds, usage["seconds"], "time limit"),
+                                  (self.max_prompt_tokens, usage["prompt_tokens"], "prompt token limit"),
+                                  (self.max_completion_tokens, usage["completion_tokens"], "completion token limit"),
+                                  (self.max_tool_calls, usage["tool_calls"], "tool call limit")]:
+            if limit is not None and used > limit:
+                return f"Went over the {what} ({limit:,})"
+        return None
+
+    def progress(self, usage: dict) -> float:
+        """
+        Returns the fraction of the most used part of the budget, between 0 and 1
+        """
+        fractions = [used / limit for limit, used in [(self.max_seconds, usage["seconds"]),
+                                                      (self.max_prompt_tokens, usage["prompt_tokens"]),
+                                                      (self.max_completion_tokens, usage["completion_tokens"]),
+                                                      (self.max_tool_calls, usage["tool_calls"])]
+                     if limit]
+        return min(max(fractions, default=0.0), 1.0)
+
+
+class LiveRun:
+    """
+    A run streamed by a background worker, with every event buffered server-side
+    so that a rerun of the script can replay it and continue streaming
+    """
+    def __init__(self, client, session_key: str, thread_id: str, context: Optional[dict] = None,
+                 budget: Optional[RunBudget] = None, cleanup: Optional[Callable] = None):
+        self.client = client
+        self.session_key = session_key
+        self.thread_id = thread_id
+        self.context = context or {}
+        self.budget = budget or RunBudget()
+        self.cleanup = cleanup
+        self.run_id = None
+        self.events = []
+        self.done = False
+        self.error = None
+        self.stop_reason = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tool_call_ids = set()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.last_seen = time.monotonic()
+        self.condition = threading.Condition()
+
+    def touch(self) -> None:
+        """
+        Record that a script is still following the run
+        """
+        self.last_seen = time.monotonic()
+
+    def append(self, event) -> None:
+        """
+        Buffer an event and wake up the followers
+        """
+        with self.condition:
+            if event.event == "thread.run.created":
+                self.run_id = event.data.id
+            elif event.event == "thread.run.step.delta":
+                step_details = event.data.delta.step_details
+                if step_details is not None and step_details.type == "tool_calls":
+                    for tool_call in step_details.tool_calls or []:
+                        self.tool_call_ids.add((event.data.id, tool_call.index))
+            elif event.event.startswith("thread.run.step.") and getattr(event.data, "usage", None) is not None:
+                # Usage is reported once a step is over
+                self.prompt_tokens += event.data.usage.prompt_tokens
+                self.completion_tokens += event.data.usage.completion_tokens
+            self.events.append(event)
+            self.condition.notify_all()
+        if event.event == "thread.run.created" and self.stop_reason is not None:
+            # Stopped before OpenAI had even created the run
+            self.cancel()
+        self.enforce_budget()
+
+    def usage(self) -> dict:
+        """
+        What the run has used so far
+        """
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return {"seconds": end - self.started_at,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "tool_calls": len(self.tool_call_ids)}
+
+    def enforce_budget(self) -> None:
+        """
+        Stop the run if it has gone over its budget
+        """
+        if self.stop_reason is None and not self.done:
+            reason = self.budget.exceeded(self.usage())
+            if reason is not None:
+                self.stop(reason)
+
+    def stop(self, reason: str) -> None:
+        """
+        Stop the run: it is cancelled on the OpenAI side, and its stream ends with whatever was produced so far
+        """
+        if self.stop_reason is None and not self.done:
+            self.stop_reason = reason
+            print(f"Stopping run: \t {self.run_id} ({reason})")
+            self.cancel()
+
+    def finish(self, error: Optional[Exception] = None) -> None:
+        """
+        Mark the run as finished and wake up the followers
+        """
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+    def cancel(self) -> None:
+        """
+        Cancel the run on the OpenAI side, if it is still going
+        """
+        if self.done or self.run_id is None:
+            return
+        try:
+            self.client.beta.threads.runs.cancel(run_id=self.run_id, thread_id=self.thread_id)
+            print(f"Cancelled run: \t {self.run_id}")
+        except Exception as exc:
+            print(f"Failed to cancel run: \t {self.run_id} ({exc})")
+
+
+class RunRegistry:
+    """
+    Process-wide registry of live runs, keyed on session and thread
+    """
+    def __init__(self, grace_period: float = RUN_GRACE_PERIOD, finished_run_ttl: float = FINISHED_RUN_TTL):
+        self.grace_period = grace_period
+        self.finished_run_ttl = finished_run_ttl
+        self._runs = {}
+        self._deferred = []
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def start(self, client, session_key: str, thread_id: str, context: Optional[dict] = None,
+              budget: Optional[RunBudget] = None, cleanup: Optional[Callable] = None, **run_kwargs) -> LiveRun:
+        """
+        Start a streamed run on a background worker and register it
+
+        Args:
+        - client (OpenAI): The client to run with
+        - session_key (str): The key of the browser session owning the run
+        - thread_id (str): The id of the thread to run
+        - context (dict): Whatever the app needs to finalize the run after a reattach
+        - budget (RunBudget): The limits on the run
+        - cleanup (Callable): Called with the run, to delete what it left behind, if no session finalizes it
+        - run_kwargs: Passed on to `client.beta.threads.runs.create`
+
+        Returns:
+        - LiveRun: The registered run
+        """
+        live_run = LiveRun(client, session_key, thread_id, context, budget, cleanup)
+        run_kwargs = {**live_run.budget.run_kwargs(), **run_kwargs}
+        with self._lock:
+            previous = self._runs.get((session_key, thread_id))
+            self._runs[(session_key, thread_id)] = live_run
+        if previous is not None:
+            previous.cancel()
+
+        worker = threading.Thread(target=self._consume,
+                                  args=(live_run, run_kwargs),
+                                  name=f"run-{thread_id}",
+                                  daemon=True)
+        worker.start()
+        self._ensure_reaper()
+        return live_run
+
+    def get(self, session_key: str, thread_id: Optional[str] = None) -> Optional[LiveRun]:
+        """
+        Get the most recent run of a session, optionally for a given thread
+        """
+        with self._lock:
+            runs = [live_run for (key, tid), live_run in self._runs.items()
+                    if key == session_key and (thread_id is None or tid == thread_id)]
+        if not runs:
+            return None
+        return max(runs, key=lambda live_run: live_run.started_at)
+
+    def release(self, live_run: LiveRun) -> None:
+        """
+        Forget a run once the app has finalized it
+        """
+        with self._lock:
+            if self._runs.get((live_run.session_key, live_run.thread_id)) is live_run:
+                del self._runs[(live_run.session_key, live_run.thread_id)]
+
+    def runs(self, session_key: str) -> list[LiveRun]:
+        """
+        Get all the runs of a session, oldest first
+        """
+        with self._lock:
+            runs = [live_run for (key, _), live_run in self._runs.items() if key == session_key]
+        return sorted(runs, key=lambda live_run: live_run.started_at)
+
+    def follow(self, live_run: LiveRun, processor, poll_interval: float = 0.25, on_progress=None) -> None:
+        """
+        Replay the buffered events of a run into the stream processor, then keep
+        feeding it new events until the run is finished
+
+        Args:
+        - live_run (LiveRun): The run to follow
+        - processor (StreamProcessor): A fresh processor, whose sink draws fresh placeholders
+        - poll_interval (float): Seconds to wait for new events before checking in again
+        - on_progress (Callable): Called with the runs after every check-in, e.g. to draw their usage
+        """
+        self.follow_all([(live_run, processor)], poll_interval, on_progress)
+
+    def follow_all(self, followed: list, poll_interval: float = 0.25, on_progress=None) -> None:
+        """
+        Follow several runs at once, feeding each its own stream processor in turn,
+        until all of them are finished
+
+        Args:
+        - followed (list[tuple[LiveRun, StreamProcessor]]): The runs and their processors
+        - poll_interval (float): Seconds to wait for new events before checking in again
+        - on_progress (Callable): Called with the runs after every check-in, e.g. to draw their usage
+
+        Raises:
+        - Exception: The error of the first run whose stream failed, once all of them are finished
+        """
+        cursors = [0] * len(followed)
+        while True:
+            progressed, finished = False, True
+            for index, (live_run, processor) in enumerate(followed):
+                with live_run.condition:
+                    batch = live_run.events[cursors[index]:]
+                    done = live_run.done
+                live_run.touch()
+                for event in batch:
+                    # The processor only reads the events, so they are replayed as they are
+                    processor.process(event)
+                cursors[index] += len(batch)
+                progressed = progressed or len(batch) > 0
+                finished = finished and done
+            if on_progress is not None:
+                on_progress([live_run for live_run, _ in followed])
+            if finished:
+                break
+            if not progressed:
+                # Nothing new anywhere: wait for the first run still going
+                waiting = next((index for index, (live_run, _) in enumerate(followed) if not live_run.done), None)
+                if waiting is not None:
+                    live_run = followed[waiting][0]
+                    with live_run.condition:
+                        if not live_run.done and len(live_run.events) == cursors[waiting]:
+                            live_run.condition.wait(timeout=poll_interval)
+        # A run whose stream failed is forgotten, so that the session can ask again, and its error raised
+        errors = [live_run.error for live_run, _ in followed if live_run.error is not None]
+        for live_run, _ in followed:
+            if live_run.error is not None:
+                print(f"Failed run: \t {live_run.run_id} ({live_run.error})")
+                self.release(live_run)
+        if errors:
+            raise errors[0]
+
+    def defer(self, delay: float, callback, *args) -> None:
+        """
+        Call `callback(*args)` from the reaper once `delay` seconds have passed,
+        e.g. to clean up artifacts the user may still download
+
+        Args:
+        - delay (float): Seconds to wait before the call
+        - callback (Callable): The function to call
+        - args: Passed on to the callback
+        """
+        with self._lock:
+            self._deferred.append((time.monotonic() + delay, callback, args))
+        self._ensure_reaper()
+
+    def reap(self) -> None:
+        """
+        Stop the live runs nobody has followed within the grace period, drop the finished
+        runs nobody came back for, deferring their cleanup, and make the deferred calls due
+        """
+        now = time.monotonic()
+        with self._lock:
+            runs = list(self._runs.values())
+            due = [deferred for deferred in self._deferred if deferred[0] <= now]
+            self._deferred = [deferred for deferred in self._deferred if deferred[0] > now]
+        for _, callback, args in due:
+            try:
+                callback(*args)
+            except Exception as exc:
+                print(f"Deferred call failed: \t {callback.__name__} ({exc})")
+        for live_run in runs:
+            live_run.enforce_budget()
+            if not live_run.done and now - live_run.last_seen > self.grace_period:
+                # Only cancelled once, while the stream winds down
+                live_run.stop("Orphaned")
+            elif live_run.done and now - live_run.finished_at > self.finished_run_ttl:
+                self.release(live_run)
+                if live_run.cleanup is not None:
+                    self.defer(0, live_run.cleanup, live_run)
+
+    def _consume(self, live_run: LiveRun, run_kwargs: dict) -> None:
+        """
+        Worker loop: buffer every event of the run until the stream ends
+        """
+        try:
+            stream = live_run.client.beta.threads.runs.create(thread_id=live_run.thread_id,
+                                                              stream=True,
+                                                              **run_kwargs)
+            for event in stream:
+                live_run.append(event)
+        except Exception as exc:
+            live_run.finish(exc)
+        else:
+            live_run.finish()
+
+    def _ensure_reaper(self) -> None:
+        """
+        Start the reaper thread, if not already running
+        """
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name="run-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_forever(self) -> None:
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            self.reap()
+
+
+# Streamlit imports modules once per process, so this is shared by every session
+run_registry = RunRegistry()
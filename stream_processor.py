@@ -0,0 +1,246 @@
+"""
+stream_processor.py
+"""
+from typing import Iterable, Optional
+
+# Run events after which the run streams nothing more
+RUN_END_EVENTS = {"thread.run.completed",
+                  "thread.run.failed",
+                  "thread.run.cancelled",
+                  "thread.run.expired",
+                  "thread.run.incomplete",
+                  "thread.run.requires_action"}
+
+
+class TranscriptItem:
+    """
+    A piece of a run's transcript: a text, the code of a tool call, the logs of its output, or an image.
+    Text is kept as the list of its chunks, so that a delta is appended without copying what came before.
+
+    Args:
+    - item_type (str): "text", "code_input", "code_output" or "image"
+    - key (tuple): Identifies the item in the stream: the message or step id, then the indexes in it
+    - thread_id (str): The thread of the run
+    - file_id (str): The file of an image
+    """
+    __slots__ = ("type", "key", "thread_id", "file_id", "chunks", "done")
+
+    def __init__(self, item_type: str, key: tuple, thread_id: Optional[str] = None, file_id: Optional[str] = None):
+        self.type = item_type
+        self.key = key
+        self.thread_id = thread_id
+        self.file_id = file_id
+        self.chunks = []
+        self.done = False
+
+    @property
+    def content(self) -> str:
+        """
+        The text of the item so far
+        """
+        if len(self.chunks) > 1:
+            self.chunks[:] = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    @property
+    def name(self) -> str:
+        """
+        A name for the item, unique across threads, e.g. to save it to a file
+        """
+        return "_".join(str(part) for part in (self.thread_id, *self.key))
+
+
+def transcript_text(items: list[TranscriptItem]) -> str:
+    """
+    The text of a transcript, without its code, outputs and images
+    """
+    return "\n\n".join(item.content for item in items if item.type == "text")
+
+
+class TranscriptSink:
+    """
+    Where the transcript goes as it is built, e.g. drawn by a frontend or written by a batch job.
+    Every method does nothing by default.
+    """
+    def on_item_created(self, item: TranscriptItem) -> None:
+        """
+        Called when an item starts, before its first delta
+        """
+
+    def on_item_delta(self, item: TranscriptItem, delta: str) -> None:
+        """
+        Called when text is appended to an item, which is already in `item.chunks`
+        """
+
+    def on_item_done(self, item: TranscriptItem) -> None:
+        """
+        Called when an item is complete
+        """
+
+    def on_run_done(self, run) -> None:
+        """
+        Called when the run ends, whatever its status
+        """
+
+
+class StreamProcessor:
+    """
+    Turns the events of an Assistant run stream into transcript items, in a single pass,
+    and hands every update to a sink. Every tool call and every output of a step is kept.
+
+    Events are only read, never modified, so the same events can be replayed into several processors.
+    Each event is dispatched by its name, and each delta updates its item by key, so the work per delta
+    does not grow with the transcript.
+
+    Args:
+    - sink (TranscriptSink): Where the updates go, defaults to none
+    """
+    def __init__(self, sink: Optional[TranscriptSink] = None):
+        self.sink = TranscriptSink() if sink is None else sink
+        self.items = []
+        self.run = None
+        self._items_by_key = {}
+        self._open_items = {}
+        self._thread_ids = {}
+        # A chart is reported both as an output of its step and as a file of the message after it
+        self._image_file_ids = set()
+        self._handlers = {"thread.run.step.created": self._on_created,
+                          "thread.run.step.delta": self._on_step_delta,
+                          "thread.run.step.completed": self._on_step_completed,
+                          "thread.run.step.cancelled": self._on_step_completed,
+                          "thread.run.step.failed": self._on_step_completed,
+                          "thread.run.step.expired": self._on_step_completed,
+                          "thread.message.created": self._on_created,
+                          "thread.message.delta": self._on_message_delta,
+                          "thread.message.completed": self._on_message_completed,
+                          "thread.message.incomplete": self._on_message_completed}
+
+    def process(self, event) -> None:
+        """
+        Process an event of the stream
+        """
+        handler = self._handlers.get(event.event)
+        if handler is not None:
+            handler(event.data)
+        elif event.event in RUN_END_EVENTS:
+            # Close whatever was cut short, e.g. when the run was stopped or failed
+            for owner_id in list(self._open_items):
+                self._finish_all(owner_id)
+            self.run = event.data
+            self.sink.on_run_done(event.data)
+
+    def process_all(self, events: Iterable) -> list[TranscriptItem]:
+        """
+        Process every event of a stream
+
+        Returns:
+        - list[TranscriptItem]: The transcript
+        """
+        for event in events:
+            self.process(event)
+        return self.items
+
+    # Items
+    def _create(self, item_type: str, key: tuple, file_id: Optional[str] = None) -> TranscriptItem:
+        item = TranscriptItem(item_type, key, self._thread_ids.get(key[0]), file_id)
+        self._items_by_key[key] = item
+        self._open_items.setdefault(key[0], []).append(item)
+        self.items.append(item)
+        self.sink.on_item_created(item)
+        return item
+
+    def _append(self, item: TranscriptItem, delta: Optional[str]) -> None:
+        if delta:
+            item.chunks.append(delta)
+            self.sink.on_item_delta(item, delta)
+
+    def _finish(self, item: TranscriptItem) -> None:
+        if not item.done:
+            item.done = True
+            self.sink.on_item_done(item)
+
+    def _create_image(self, key: tuple, file_id: str) -> None:
+        if file_id not in self._image_file_ids:
+            self._image_file_ids.add(file_id)
+            self._finish(self._create("image", key, file_id))
+
+    def _finish_all(self, owner_id: str) -> None:
+        for item in self._open_items.pop(owner_id, []):
+            self._finish(item)
+
+    # Steps and messages
+    def _on_created(self, data) -> None:
+        self._thread_ids[data.id] = data.thread_id
+
+    def _on_code(self, step_id: str, index: int, code: Optional[str], outputs: list, is_delta: bool) -> None:
+        """
+        The code of a tool call and its outputs, from a step delta, or in full from the completed step
+        """
+        code_item = self._items_by_key.get((step_id, index))
+        if code_item is None and code:
+            code_item = self._create("code_input", (step_id, index))
+            self._append(code_item, code)
+        elif code_item is not None and is_delta:
+            self._append(code_item, code)
+
+        for position, output in enumerate(outputs):
+            key = (step_id, index, output.index if is_delta else position)
+            output_item = self._items_by_key.get(key)
+            if output_item is not None:
+                if is_delta and output.type == "logs":
+                    self._append(output_item, output.logs)
+                continue
+            # The code has run
+            if code_item is not None:
+                self._finish(code_item)
+            if output.type == "logs":
+                self._append(self._create("code_output", key), output.logs)
+            elif output.type == "image":
+                self._create_image(key, output.image.file_id)
+
+    def _on_step_delta(self, step_delta) -> None:
+        step_details = step_delta.delta.step_details
+        if step_details is None or step_details.type != "tool_calls":
+            return
+        for tool_call in step_details.tool_calls or []:
+            if tool_call.type == "code_interpreter" and tool_call.code_interpreter is not None:
+                self._on_code(step_delta.id,
+                              tool_call.index,
+                              tool_call.code_interpreter.input,
+                              tool_call.code_interpreter.outputs or [],
+                              is_delta=True)
+
+    def _on_step_completed(self, step) -> None:
+        # Whatever was not streamed is only in the completed step, also called when the step ends otherwise
+        if step.step_details.type == "tool_calls":
+            for index, tool_call in enumerate(step.step_details.tool_calls):
+                if tool_call.type == "code_interpreter":
+                    self._on_code(step.id,
+                                  index,
+                                  tool_call.code_interpreter.input,
+                                  tool_call.code_interpreter.outputs or [],
+                                  is_delta=False)
+        self._finish_all(step.id)
+
+    def _on_message_content(self, message_id: str, index: int, content, is_delta: bool) -> None:
+        key = (message_id, index)
+        item = self._items_by_key.get(key)
+        if content.type == "text":
+            if item is None:
+                item = self._create("text", key)
+            elif not is_delta:
+                return
+            if content.text is not None:
+                self._append(item, content.text.value)
+        elif content.type == "image_file" and item is None:
+            self._create_image(key, content.image_file.file_id)
+
+    def _on_message_delta(self, message_delta) -> None:
+        for content in message_delta.delta.content or []:
+            self._on_message_content(message_delta.id, content.index, content, is_delta=True)
+
+    def _on_message_completed(self, message) -> None:
+        # Whatever was not streamed is only in the completed message
+        for index, content in enumerate(message.content):
+            self._on_message_content(message.id, index, content, is_delta=False)
+        self._finish_all(message.id)
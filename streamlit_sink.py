@@ -0,0 +1,57 @@
+"""
+streamlit_sink.py
+"""
+import streamlit as st
+
+from log_buffer import LogBuffer
+from stream_processor import TranscriptItem, TranscriptSink
+from utils import load_image_html, remove_links, render_log
+
+
+class StreamlitSink(TranscriptSink):
+    """
+    Draws the transcript of a run in Streamlit as it streams, each item in a placeholder of its own
+
+    Args:
+    - container (DeltaGenerator): Where the transcript is drawn, defaults to the main body
+    """
+    def __init__(self, container=None) -> None:
+        self.container = st if container is None else container
+        self.placeholders = {}
+        self.code_expanders = {}
+        self.logs = {}
+
+    def on_item_created(self, item: TranscriptItem) -> None:
+        if item.type == "text":
+            self.placeholders[item.key] = self.container.empty()
+
+        elif item.type == "code_input":
+            # Nest the code in an expander
+            self.code_expanders[item.key] = self.container.status("**💻 Code**", expanded=True)
+            self.placeholders[item.key] = self.code_expanders[item.key].empty()
+
+        elif item.type == "code_output":
+            # Nest the output in an expander, which only keeps the head and tail of big logs
+            self.placeholders[item.key] = self.container.expander(label="**🔎 Output**").empty()
+            self.logs[item.key] = LogBuffer(item.name)
+
+        elif item.type == "image":
+            # Download the file from OpenAI and encode it, unless it is cached, e.g. when the run is replayed
+            self.container.html(load_image_html(item.file_id, delete=True))
+
+    def on_item_delta(self, item: TranscriptItem, delta: str) -> None:
+        if item.type == "text":
+            # Re-display the full text, without the sandbox links
+            self.placeholders[item.key].info(remove_links(f"**> 🕵️ DAVE:** \n\n {item.content}"))
+
+        elif item.type == "code_input":
+            self.placeholders[item.key].code(item.content)
+
+        elif item.type == "code_output":
+            self.logs[item.key].append(f"\n\n{delta}")
+            render_log(self.placeholders[item.key].container(), self.logs[item.key])
+
+    def on_item_done(self, item: TranscriptItem) -> None:
+        if item.type == "code_input":
+            # Collapse the code, once it has run
+            self.code_expanders[item.key].update(state="complete", expanded=False)
@@ -0,0 +1,24 @@
+"""
+tests/test_cache.py
+"""
+from cache import Cache, LRUCacheBackend, SQLiteCacheBackend
+
+
+def test_hits_and_misses_are_counted_per_namespace():
+    backend = LRUCacheBackend()
+    cache = Cache("guardrails", backend)
+    cache.get_or_set("text", lambda: False)
+    cache.get_or_set("text", lambda: True)
+    cache.get("other")
+
+    assert backend.stats() == {"guardrails": {"hits": 1, "misses": 2}}
+
+
+def test_sqlite_counters_are_shared_by_every_backend_on_the_file(tmp_path):
+    path = str(tmp_path / "cache.db")
+    Cache("images", SQLiteCacheBackend(path)).set("file", "<img>")
+    # As if from another process
+    Cache("images", SQLiteCacheBackend(path)).get("file")
+    Cache("images", SQLiteCacheBackend(path)).get("missing")
+
+    assert SQLiteCacheBackend(path).stats() == {"images": {"hits": 1, "misses": 1}}
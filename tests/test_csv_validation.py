@@ -0,0 +1,22 @@
+"""
+tests/test_csv_validation.py
+"""
+import io
+
+import pytest
+
+from csv_validation import CSV_CHUNK_SIZE, CSVValidationError, normalize_csv
+
+
+def test_byte_undefined_in_the_fallback_encoding_fails_validation():
+    rows = b"a,b\n" + b"x,y\n" * (CSV_CHUNK_SIZE // 4 + 1000)
+
+    with pytest.raises(CSVValidationError, match="neither valid UTF-8 nor cp1252"):
+        normalize_csv(io.BytesIO(rows + b"\x81,z\n"))
+
+
+def test_cp1252_file_is_normalized_to_utf8():
+    normalized, report = normalize_csv(io.BytesIO("name;price\ncafé;3\n".encode("cp1252")))
+
+    assert report["encoding"] == "cp1252"
+    assert normalized.read().decode("utf-8") == "name,price\ncafé,3\n"
@@ -0,0 +1,27 @@
+"""
+tests/test_downloads.py
+"""
+import os
+
+import utils
+
+
+def test_no_files_deletes_no_bundle(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "DOWNLOAD_DIR", str(tmp_path))
+    other_bundle = os.path.join(utils.bundle_dir(["file-a", "file-b"]), "dave_files.zip")
+    os.makedirs(os.path.dirname(other_bundle))
+    open(other_bundle, "wb").close()
+
+    utils.delete_downloads([])
+
+    assert os.path.exists(other_bundle)
+
+
+def test_bundle_dir_name_stays_short(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "DOWNLOAD_DIR", str(tmp_path))
+    file_ids = [f"file-{index:024d}" for index in range(20)]
+
+    path = utils.bundle_dir(file_ids)
+    os.makedirs(path)
+    assert len(os.path.basename(path)) == 64
+    assert path == utils.bundle_dir(list(reversed(file_ids)))
@@ -0,0 +1,43 @@
+"""
+tests/test_log_buffer.py
+"""
+import pytest
+
+import log_buffer
+from log_buffer import LogBuffer
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_buffer, "LOG_DIR", str(tmp_path))
+
+
+@pytest.mark.parametrize("chunks", [
+    ["abcdé", "XY"],
+    ["é" * 7, "ab", "ü€"],
+    ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l"],
+    ["0123456789" * 3],
+])
+def test_head_is_a_prefix_and_tail_a_suffix(chunks):
+    buffer = LogBuffer("log", budget=10)
+    for chunk in chunks:
+        buffer.append(chunk)
+    full_log = "".join(chunks)
+    stored = buffer.to_dict()
+
+    assert full_log.startswith(stored["head"])
+    assert full_log.endswith(stored["tail"])
+    with open(buffer.path, encoding="utf-8") as file:
+        assert file.read() == full_log
+
+    restored = LogBuffer.from_dict(stored)
+    assert restored.render() == buffer.render()
+    restored.append("Z")
+    assert restored.to_dict()["head"] == stored["head"]
+
+
+def test_short_log_is_kept_in_full():
+    buffer = LogBuffer("log", budget=10)
+    buffer.append("abcdé")
+
+    assert buffer.render() == "abcdé"
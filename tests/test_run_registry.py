@@ -0,0 +1,58 @@
+"""
+tests/test_run_registry.py
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from run_registry import RunRegistry
+from stream_processor import StreamProcessor
+
+
+def failing_client(error: Exception) -> SimpleNamespace:
+    def create(**kwargs):
+        raise error
+    return SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=SimpleNamespace(create=create))))
+
+
+def test_failed_run_is_released():
+    registry = RunRegistry()
+    live_run = registry.start(failing_client(ConnectionError("stream cut")), "session", "thread")
+
+    with pytest.raises(ConnectionError):
+        registry.follow(live_run, StreamProcessor(), poll_interval=0.01)
+
+    # The session can ask again, instead of reattaching to the failed run
+    assert registry.get("session") is None
+
+
+def test_orphaned_run_is_cancelled_once_and_cleaned_up_once_dropped():
+    cancels, cleaned_up = [], []
+    stream_ended = threading.Event()
+
+    def create(**kwargs):
+        yield SimpleNamespace(event="thread.run.created", data=SimpleNamespace(id="run_1"))
+        stream_ended.wait(5)
+
+    client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=SimpleNamespace(
+        create=create, cancel=lambda **kwargs: cancels.append(kwargs["run_id"])))))
+    registry = RunRegistry(grace_period=0, finished_run_ttl=0)
+    # Reap by hand only, rather than from the reaper thread
+    registry._reaper = "not started"
+    live_run = registry.start(client, "session", "thread", cleanup=cleaned_up.append)
+    while live_run.run_id is None:
+        time.sleep(0.01)
+
+    registry.reap()
+    registry.reap()
+    assert cancels == ["run_1"]
+
+    stream_ended.set()
+    while not live_run.done:
+        time.sleep(0.01)
+    registry.reap()
+    assert registry.get("session") is None
+    registry.reap()
+    assert cleaned_up == [live_run]
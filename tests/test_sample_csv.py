@@ -0,0 +1,42 @@
+"""
+tests/test_sample_csv.py
+"""
+import csv
+import io
+
+from utils import MAX_STRATA, allocate_sample, sample_csv
+
+
+def csv_file(rows: int, groups: int) -> io.BytesIO:
+    lines = ["id,group"] + [f"{row},g{row % groups}" for row in range(rows)]
+    return io.BytesIO("\n".join(lines).encode("utf-8"))
+
+
+def sampled_rows(sample: bytes) -> list:
+    return list(csv.DictReader(io.StringIO(sample.decode("utf-8"))))
+
+
+def test_high_cardinality_column_falls_back_to_one_reservoir():
+    sample, sample_rows, total_rows = sample_csv(csv_file(50000, 1), 1000, stratify_by="id")
+
+    assert (sample_rows, total_rows) == (1000, 50000)
+    assert len(sampled_rows(sample)) == 1000
+
+
+def test_stratified_sample_keeps_its_size_and_every_stratum():
+    file = csv_file(10000, MAX_STRATA)
+    sample, sample_rows, total_rows = sample_csv(file, 999, stratify_by="group")
+
+    rows = sampled_rows(sample)
+    assert sample_rows == len(rows) == 999
+    assert {row["group"] for row in rows} == {f"g{group}" for group in range(MAX_STRATA)}
+    # The file is handed back rewound, to be uploaded in full
+    assert file.tell() == 0
+
+
+def test_allocation_never_exceeds_the_sample():
+    counts = {"big": 9990, **{f"small{index}": 1 for index in range(10)}}
+
+    allocations = allocate_sample(counts, 100)
+    assert sum(allocations.values()) == 100
+    assert all(allocation >= 1 for allocation in allocations.values())
@@ -0,0 +1,66 @@
+"""
+tests/test_stream_processor.py
+"""
+from types import SimpleNamespace as Data
+
+from stream_processor import StreamProcessor
+
+
+def event(name: str, **data) -> Data:
+    return Data(event=name, data=Data(**data))
+
+
+def chart_run_events(file_id: str) -> list:
+    """
+    A run which draws a chart: reported as an image output of its step, then as a file of its message
+    """
+    tool_call = Data(type="code_interpreter",
+                     code_interpreter=Data(input="plt.show()",
+                                           outputs=[Data(type="image", image=Data(file_id=file_id))]))
+    return [
+        event("thread.run.step.created", id="step_1", thread_id="thread_1"),
+        event("thread.run.step.completed", id="step_1", thread_id="thread_1",
+              step_details=Data(type="tool_calls", tool_calls=[tool_call])),
+        event("thread.message.created", id="msg_1", thread_id="thread_1"),
+        event("thread.message.completed", id="msg_1", thread_id="thread_1", content=[
+            Data(type="image_file", image_file=Data(file_id=file_id)),
+            Data(type="text", text=Data(value="Here is the chart"))]),
+    ]
+
+
+def test_chart_reported_twice_is_kept_once():
+    items = StreamProcessor().process_all(chart_run_events("file-img"))
+
+    assert [(item.type, item.file_id) for item in items] == [("code_input", None),
+                                                             ("image", "file-img"),
+                                                             ("text", None)]
+    assert all(item.done for item in items)
+
+
+def test_items_cut_short_are_finished_when_the_run_ends():
+    code_delta = Data(type="code_interpreter", index=0, code_interpreter=Data(input="while True:", outputs=None))
+    events = [
+        event("thread.run.step.created", id="step_1", thread_id="thread_1"),
+        event("thread.run.step.delta", id="step_1",
+              delta=Data(step_details=Data(type="tool_calls", tool_calls=[code_delta]))),
+        event("thread.run.cancelled", id="run_1", status="cancelled"),
+    ]
+    processor = StreamProcessor()
+    items = processor.process_all(events)
+
+    assert [(item.type, item.content, item.done) for item in items] == [("code_input", "while True:", True)]
+    assert processor.run.status == "cancelled"
+
+
+def test_failed_step_finishes_its_items():
+    code_delta = Data(type="code_interpreter", index=0, code_interpreter=Data(input="1 / 0", outputs=None))
+    events = [
+        event("thread.run.step.created", id="step_1", thread_id="thread_1"),
+        event("thread.run.step.delta", id="step_1",
+              delta=Data(step_details=Data(type="tool_calls", tool_calls=[code_delta]))),
+        event("thread.run.step.failed", id="step_1", thread_id="thread_1",
+              step_details=Data(type="tool_calls", tool_calls=[])),
+    ]
+    items = StreamProcessor().process_all(events)
+
+    assert [(item.type, item.done) for item in items] == [("code_input", True)]
@@ -0,0 +1,167 @@
+"""
+transcript_store.py
+"""
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Where the transcripts are kept
+TRANSCRIPT_DB = os.environ.get("DAVE_TRANSCRIPT_DB", "transcripts.db")
+# Sessions not updated for this many days are deleted when the store is opened
+TRANSCRIPT_RETENTION_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_key TEXT PRIMARY KEY,
+    thread_id TEXT,
+    file_ids TEXT NOT NULL DEFAULT '[]',
+    context_turn INTEGER NOT NULL DEFAULT 0,
+    recap TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    session_key TEXT NOT NULL REFERENCES sessions(session_key) ON DELETE CASCADE,
+    turn INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    type TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_by_session ON items (session_key, turn, position);
+CREATE INDEX IF NOT EXISTS sessions_by_update ON sessions (updated_at);
+"""
+# Columns added since the first version of the schema, to add to older stores
+MIGRATIONS = {"sessions": {"context_turn": "INTEGER NOT NULL DEFAULT 0",
+                           "recap": "TEXT"}}
+
+
+class TranscriptStore:
+    """
+    Keeps the chat transcripts in SQLite, so that a session can be reloaded without any API call.
+    Items are written as they are created, and updated once complete.
+    """
+    def __init__(self, path: str = TRANSCRIPT_DB):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+
+    def _migrate(self) -> None:
+        for table, columns in MIGRATIONS.items():
+            existing_columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+            for column, definition in columns.items():
+                if column not in existing_columns:
+                    self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connection.execute(sql, parameters)
+
+    def save_session(self, session_key: str, thread_id: str, file_ids: list[str]) -> None:
+        """
+        Create or update a session
+        """
+        now = time.time()
+        self._execute("""
+            INSERT INTO sessions (session_key, thread_id, file_ids, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (session_key) DO UPDATE SET thread_id = excluded.thread_id,
+                                                    file_ids = excluded.file_ids,
+                                                    updated_at = excluded.updated_at
+            """, (session_key, thread_id, json.dumps(file_ids), now, now))
+
+    def save_context(self, session_key: str, thread_id: str, context_turn: int, recap: Optional[str]) -> None:
+        """
+        Record that a session moved to a new thread, which holds the turns from `context_turn` on,
+        after a recap of the turns before
+        """
+        self._execute("""
+            UPDATE sessions SET thread_id = ?, context_turn = ?, recap = ?, updated_at = ? WHERE session_key = ?
+            """, (thread_id, context_turn, recap, time.time(), session_key))
+
+    def load_session(self, session_key: str) -> Optional[dict]:
+        """
+        Returns the thread id, file ids, first turn in the thread and recap of a session, if it exists
+        """
+        row = self._execute("SELECT thread_id, file_ids, context_turn, recap FROM sessions WHERE session_key = ?",
+                            (session_key,)).fetchone()
+        if row is None:
+            return None
+        return {"thread_id": row[0], "file_ids": json.loads(row[1]), "context_turn": row[2], "recap": row[3]}
+
+    def append_item(self, session_key: str, turn: int, position: int, role: str, item_type: str, content) -> int:
+        """
+        Write a new item of a turn
+
+        Args:
+        - session_key (str): The key of the session
+        - turn (int): The index of the message in the session
+        - position (int): The index of the item in the message
+        - role (str): "user" or "assistant"
+        - item_type (str): "text", "code_input", "code_output" or "image"
+        - content: The content of the item, as JSON-serialisable data
+
+        Returns:
+        - int: The id of the item, to update it with
+        """
+        cursor = self._execute("""
+            INSERT INTO items (session_key, turn, position, role, type, content) VALUES (?, ?, ?, ?, ?, ?)
+            """, (session_key, turn, position, role, item_type, json.dumps(content)))
+        self._execute("UPDATE sessions SET updated_at = ? WHERE session_key = ?", (time.time(), session_key))
+        return cursor.lastrowid
+
+    def update_item(self, item_id: int, content) -> None:
+        """
+        Overwrite the content of an item
+        """
+        self._execute("UPDATE items SET content = ? WHERE id = ?", (json.dumps(content), item_id))
+
+    def load_messages(self, session_key: str) -> list[dict]:
+        """
+        Load the transcript of a session, in a single indexed query
+
+        Returns:
+        - list[dict]: The messages, each with its role and list of items
+        """
+        rows = self._execute("""
+            SELECT id, turn, role, type, content FROM items WHERE session_key = ? ORDER BY turn, position
+            """, (session_key,)).fetchall()
+        messages = []
+        last_turn = None
+        for item_id, turn, role, item_type, content in rows:
+            if turn != last_turn:
+                messages.append({"role": role, "items": []})
+                last_turn = turn
+            messages[-1]["items"].append({"id": item_id, "type": item_type, "content": json.loads(content)})
+        return messages
+
+    def compact(self, retention_days: float = TRANSCRIPT_RETENTION_DAYS) -> int:
+        """
+        Delete the sessions not updated within the retention period, and reclaim their space
+
+        Returns:
+        - int: The number of sessions deleted
+        """
+        cutoff = time.time() - retention_days * 24 * 60 * 60
+        deleted = self._execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,)).rowcount
+        if deleted > 0:
+            self._execute("VACUUM")
+        return deleted
+
+
+@functools.lru_cache(maxsize=None)
+def get_transcript_store() -> TranscriptStore:
+    """
+    Open the transcript store on first use, compacting it once per process
+    """
+    transcript_store = TranscriptStore()
+    transcript_store.compact()
+    return transcript_store
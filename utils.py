@@ -3,28 +3,86 @@ utils.py
 """
 import os
 import base64
-import hmac
+import csv
+import functools
+import hashlib
+import io
+import json
+import random
+import mimetypes
 import re
-from PIL import ImageFile
-from typing import Tuple
-from typing_extensions import override
+import shutil
+import tempfile
+import uuid
+import zipfile
+from typing import TYPE_CHECKING, Optional, Tuple
 
 import streamlit as st
-from openai import (
-    OpenAI,
-    AssistantEventHandler
-    )
-from openai.types.beta.threads import Text, TextDelta
-from openai.types.beta.threads.runs import ToolCall, ToolCallDelta
+from artifact_store import ArtifactStore, file_digest, record_dedup
+from cache import get_cache
+from csv_validation import CSVValidationError, normalize_csv
+from log_buffer import delete_logs
 
-# Get secrets
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", st.secrets["OPENAI_API_KEY"])
+# The OpenAI SDK is slow to import, so it is only imported on first use
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.types.beta import Assistant
 
 # Config
 LAST_UPDATE_DATE = "2024-04-08"
+# Where the files created by the Assistant are saved once the user asks for them
+DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), "dave-downloads")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# The images and the files created by the Assistant, kept by content so that duplicates share one copy
+image_store = ArtifactStore("images")
+download_store = ArtifactStore(DOWNLOAD_DIR)
+# Seconds the files created by the Assistant stay downloadable after a run
+DOWNLOAD_TTL = 1800
+# Progressive mode: past this many distinct values, a sample is no longer stratified, see `sample_csv`
+MAX_STRATA = 20
+# Fan-out mode: the most sub-questions answered in parallel
+MAX_SUB_QUESTIONS = 4
+# Limits on every run, see `run_registry.RunBudget`
+RUN_BUDGET = {"max_seconds": 600,
+              "max_prompt_tokens": 500000,
+              "max_completion_tokens": 20000,
+              "max_tool_calls": 25}
+
+def get_secret(name: str) -> str:
+    """
+    Reads a secret from the environment, falling back on the Streamlit secrets
+
+    Args:
+    - name (str): The name of the secret
 
-# Initialise the OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+    Returns:
+    - str: The secret
+    """
+    return os.environ.get(name) or st.secrets[name]
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> "OpenAI":
+    """
+    Initialise the OpenAI client on first use, so that the app is drawn before the SDK is even imported
+
+    Returns:
+    - OpenAI: The client, shared by every session of the process
+    """
+    from openai import OpenAI
+    return OpenAI(api_key=get_secret("OPENAI_API_KEY"))
+
+def get_assistant(assistant_id: str) -> "Assistant":
+    """
+    Retrieve the assistant on first use, and cache it
+
+    Args:
+    - assistant_id (str): The id of the assistant
+
+    Returns:
+    - Assistant: The assistant
+    """
+    return get_cache("assistants").get_or_set(assistant_id,
+                                              lambda: get_client().beta.assistants.retrieve(assistant_id))
 
 def render_custom_css() -> None:
     """
@@ -51,16 +109,227 @@ def initialise_session_state():
     if "file" not in st.session_state:
         st.session_state.file = None
 
-    if "assistant_text" not in st.session_state:
-        st.session_state.assistant_text = [""]
-
     for session_state_var in ["file_uploaded", "read_terms"]:
         if session_state_var not in st.session_state:
             st.session_state[session_state_var] = False
 
-    for session_state_var in ["code_input", "code_output"]:
-        if session_state_var not in st.session_state:
-            st.session_state[session_state_var] = []
+def get_session_key() -> str:
+    """
+    Returns a key identifying the browser session, which survives reruns and reconnects
+
+    Returns:
+    - str: The session key, kept in the page's query parameters
+    """
+    if "sid" not in st.query_params:
+        st.query_params["sid"] = uuid.uuid4().hex
+    return st.query_params["sid"]
+
+def normalize_uploads(files: list) -> Optional[list[tuple]]:
+    """
+    Validates the uploaded CSV file(s) and normalizes them to UTF-8 with comma delimiters,
+    before anything is uploaded. The first failure is reported right away.
+
+    Args:
+    - files (list[UploadedFile]): The uploaded file(s)
+
+    Returns:
+    - list[tuple]: The name, the normalized file and the report of each file (see `normalize_csv`), or None if a file failed
+    """
+    normalized_files = []
+    for file in files:
+        try:
+            normalized, report = normalize_csv(file)
+        except CSVValidationError as exc:
+            st.error(f"**{file.name}** is not a valid CSV file: {exc}", icon="⚠️")
+            for _, normalized, _ in normalized_files:
+                normalized.close()
+            return None
+        print(f"Validated file: \t {file.name} ({report['rows']:,} rows, {len(report['columns'])} columns, {report['encoding']}, {report['delimiter']!r})")
+        normalized_files.append((file.name, normalized, report))
+    return normalized_files
+
+def sample_csv(file, sample_size: int, stratify_by: str = "", seed: int = 0) -> Tuple[bytes, int, int]:
+    """
+    Draws a random sample of the rows of a CSV file, in a single streaming pass.
+    Uses reservoir sampling, with one reservoir per stratum when a column to stratify by is given.
+    A column with more than `MAX_STRATA` distinct values is not stratified by, so at most
+    `MAX_STRATA + 1` reservoirs of `sample_size` rows are ever held in memory.
+
+    Args:
+    - file (UploadedFile): The CSV file
+    - sample_size (int): The number of rows to sample, at most
+    - stratify_by (str): The column to stratify the sample by, if any
+    - seed (int): The seed of the random number generator
+
+    Returns:
+    - bytes: The sample, as a CSV file with the same header
+    - int: The number of rows sampled
+    - int: The number of rows in the file
+    """
+    rng = random.Random(seed)
+
+    def keep(reservoir: list, seen: int, row: list) -> None:
+        """
+        Keep the row in the reservoir, if drawn, once `seen` rows were offered to it
+        """
+        if len(reservoir) < sample_size:
+            reservoir.append(row)
+        else:
+            slot = rng.randrange(seen)
+            if slot < sample_size:
+                reservoir[slot] = row
+
+    file.seek(0)
+    text = io.TextIOWrapper(file, encoding="utf-8", errors="replace", newline="")
+    try:
+        reader = csv.reader(text)
+        header = next(reader, [])
+        stratum_index = header.index(stratify_by) if stratify_by in header else None
+
+        # A reservoir of the whole file, and one per stratum until there are too many strata
+        reservoir, total_rows = [], 0
+        reservoirs, counts = {}, {}
+        for row in reader:
+            total_rows += 1
+            keep(reservoir, total_rows, row)
+            if stratum_index is None:
+                continue
+            stratum = row[stratum_index] if stratum_index < len(row) else None
+            if stratum not in counts and len(counts) == MAX_STRATA:
+                print(f"Not stratifying: \t more than {MAX_STRATA} distinct values of {stratify_by}")
+                stratum_index, reservoirs, counts = None, {}, {}
+                continue
+            counts[stratum] = counts.get(stratum, 0) + 1
+            keep(reservoirs.setdefault(stratum, []), counts[stratum], row)
+    finally:
+        # Hand the file back open and rewound, so it can still be uploaded in full
+        text.detach()
+        file.seek(0)
+
+    sample = []
+    if counts:
+        # Allocate the sample to the strata in proportion to their size
+        for stratum, allocation in allocate_sample(counts, sample_size).items():
+            sample.extend(rng.sample(reservoirs[stratum], allocation))
+    else:
+        sample = reservoir
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    writer.writerows(sample)
+    return output.getvalue().encode("utf-8"), len(sample), total_rows
+
+def allocate_sample(counts: dict, sample_size: int) -> dict:
+    """
+    Splits a sample between strata in proportion to their size, by largest remainder,
+    keeping at least one row of each stratum when the sample has room for them
+
+    Args:
+    - counts (dict): The number of rows of each stratum
+    - sample_size (int): The number of rows to sample, at most
+
+    Returns:
+    - dict: The number of rows to sample from each stratum, adding up to `sample_size` at most
+    """
+    # One row of each stratum first, then the rest of the sample in proportion to the rows left
+    allocations = {stratum: 1 if len(counts) <= sample_size else 0 for stratum in counts}
+    rows_left = {stratum: count - allocations[stratum] for stratum, count in counts.items()}
+    left = min(sample_size, sum(counts.values())) - sum(allocations.values())
+    total_left = sum(rows_left.values())
+    shares = {stratum: left * rows / total_left if total_left else 0 for stratum, rows in rows_left.items()}
+    for stratum, share in shares.items():
+        allocations[stratum] += int(share)
+    # Hand out what the rounding left over, by largest remainder
+    left -= sum(int(share) for share in shares.values())
+    for stratum in sorted(shares, key=lambda stratum: int(shares[stratum]) - shares[stratum])[:left]:
+        allocations[stratum] += 1
+    return allocations
+
+def render_run_progress(progress_box, live_runs: list) -> None:
+    """
+    Renders what the run(s) have used so far, against their budget
+
+    Args:
+    - progress_box (DeltaGenerator): The placeholder to render in
+    - live_runs (list[LiveRun]): The run(s) followed
+    """
+    usages = [live_run.usage() for live_run in live_runs]
+    fraction = max(live_run.budget.progress(usage) for live_run, usage in zip(live_runs, usages))
+    seconds = max(usage["seconds"] for usage in usages)
+    prompt_tokens = sum(usage["prompt_tokens"] for usage in usages)
+    completion_tokens = sum(usage["completion_tokens"] for usage in usages)
+    tool_calls = sum(usage["tool_calls"] for usage in usages)
+    progress_box.progress(fraction,
+                          text=f"⏱️ {seconds:.0f}s · 🧮 {prompt_tokens:,} prompt + {completion_tokens:,} completion tokens · 💻 {tool_calls} tool call(s)")
+
+def image_html(path: str) -> str:
+    """
+    Encodes an image saved on disk as centered HTML
+
+    Args:
+    - path (str): The path of the image
+
+    Returns:
+    - str: The HTML of the image
+    """
+    with open(path, "rb") as file:
+        data_url = base64.b64encode(file.read()).decode("utf-8")
+    return f'<p align="center"><img src="data:image/png;base64,{data_url}" width=600></p>'
+
+def load_image_html(file_id: str, delete: bool = False) -> str:
+    """
+    Returns the HTML of an image created by the Assistant, which is only downloaded once.
+    Identical images, within and across sessions, share one saved copy and one encoding.
+
+    Args:
+    - file_id (str): The id of the image file
+    - delete (bool): Whether to delete the file from OpenAI once downloaded
+
+    Returns:
+    - str: The HTML of the image
+    """
+    path = f"images/{file_id}.png"
+
+    def download() -> str:
+        # The image may already be saved, e.g. when a run is replayed after the cache dropped it
+        if os.path.exists(path):
+            return file_digest(path)
+        with get_client().files.with_streaming_response.content(file_id) as response:
+            digest = image_store.put(response.iter_bytes(DOWNLOAD_CHUNK_SIZE), path)
+        if delete:
+            get_client().files.delete(file_id)
+        return digest
+
+    images = get_cache("images")
+    digest = images.get_or_set(f"file:{file_id}", download)
+
+    # Encode the content once, whichever file it came from
+    encoded = images.get(f"sha256:{digest}")
+    if encoded is None:
+        encoded = image_html(path)
+        images.set(f"sha256:{digest}", encoded)
+    else:
+        record_dedup("encodes_skipped")
+    return encoded
+
+def render_log(container, log_buffer) -> None:
+    """
+    Renders the head and tail of a log, with a link to the full log if it is truncated
+
+    Args:
+    - container (DeltaGenerator): Where to render the log
+    - log_buffer (LogBuffer): The log
+    """
+    container.code(log_buffer.render())
+    if log_buffer.truncated:
+        container.markdown(f"[📄 Open the full log ({log_buffer.total_bytes / 1024:,.0f} KB)]({log_buffer.url})")
+
+def hash_text(text: str) -> str:
+    """
+    Returns the SHA-256 digest of a text, to use as a cache key
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 def moderation_endpoint(text) -> bool:
     """
@@ -72,8 +341,12 @@ def moderation_endpoint(text) -> bool:
     Returns:
     - bool: True if the text is flagged
     """
-    response = client.moderations.create(input=text)
-    return response.results[0].flagged
+    def check() -> bool:
+        response = get_client().moderations.create(input=text)
+        return response.results[0].flagged
+
+    # The verdict is cached, so the same text is only ever checked once
+    return get_cache("guardrails").get_or_set(f"moderation:{hash_text(text)}", check)
 
 def is_nsfw(text) -> bool:
     """
@@ -85,18 +358,22 @@ def is_nsfw(text) -> bool:
     Returns:
     - bool: True if the text is nsfw
     """
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Is the given text NSFW? If yes, return `1``, else return `0`."},
-            {"role": "user", "content": text},
-        ],
-        max_tokens=1,
-        logit_bias={"15": 100,
-                    "16": 100},
-    )
-    output = response.choices[0].message.content
-    return bool(output)
+    def check() -> bool:
+        response = get_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": "Is the given text NSFW? If yes, return `1``, else return `0`."},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=1,
+            logit_bias={"15": 100,
+                        "16": 100},
+        )
+        output = response.choices[0].message.content
+        return bool(output)
+
+    # The verdict is cached, so the same text is only ever checked once
+    return get_cache("guardrails").get_or_set(f"nsfw:{hash_text(text)}", check)
 
 def is_not_question(text) -> bool:
     """
@@ -108,18 +385,103 @@ def is_not_question(text) -> bool:
     Returns:
     - bool: True if the text is not a question
     """
-    response = client.chat.completions.create(
+    def check() -> bool:
+        response = get_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": "Is the given text a question? If yes, return `1``, else return `0`."},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=1,
+            logit_bias={"15": 100,
+                        "16": 100},
+        )
+        output = response.choices[0].message.content
+        return bool(output)
+
+    # The verdict is cached, so the same text is only ever checked once
+    return get_cache("guardrails").get_or_set(f"not_question:{hash_text(text)}", check)
+
+def split_question(text: str, max_sub_questions: int = MAX_SUB_QUESTIONS) -> list[str]:
+    """
+    Splits a compound question into independent sub-questions, which can be answered in parallel
+
+    Args:
+    - text (str): The question to split
+    - max_sub_questions (int): The maximum number of sub-questions
+
+    Returns:
+    - list[str]: The sub-questions, or the question itself if it cannot be split
+    """
+    response = get_client().chat.completions.create(
         model="gpt-3.5-turbo",
         messages=[
-            {"role": "system", "content": "Is the given text a question? If yes, return `1``, else return `0`."},
+            {"role": "system", "content": f"Split the given data analysis question into at most {max_sub_questions} sub-questions that can each be answered independently of the others, on the same dataset(s). If the question cannot be split, return it as the only sub-question. Return a JSON object of the form {{\"sub_questions\": [\"...\"]}}."},
             {"role": "user", "content": text},
         ],
-        max_tokens=1,
-        logit_bias={"15": 100,
-                    "16": 100},
+        response_format={"type": "json_object"},
+        temperature=0,
     )
-    output = response.choices[0].message.content
-    return bool(output)
+    try:
+        sub_questions = json.loads(response.choices[0].message.content)["sub_questions"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return [text]
+    sub_questions = [sub_question for sub_question in sub_questions if isinstance(sub_question, str) and sub_question.strip()]
+    return sub_questions[:max_sub_questions] or [text]
+
+def merge_answers(text: str, sub_questions: list[str], answers: list[str], model: str):
+    """
+    Combines the answers to the sub-questions into a single answer to the question
+
+    Args:
+    - text (str): The question asked
+    - sub_questions (list[str]): The sub-questions
+    - answers (list[str]): The answer to each sub-question
+    - model (str): The model to write the answer with
+
+    Returns:
+    - Stream: The streamed answer, to be written with `st.write_stream`
+    """
+    findings = "\n\n".join(f"Sub-question: {sub_question}\nAnswer: {answer}"
+                             for sub_question, answer in zip(sub_questions, answers))
+    return get_client().chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are given a data analysis question, and the answers to its sub-questions. Combine them into a single succinct answer to the question, without technical language or markdown headers. Only use the findings given."},
+            {"role": "user", "content": f"Question: {text}\n\n{findings}"},
+        ],
+        temperature=0,
+        stream=True,
+    )
+
+def upload_file(file, file_name: Optional[str] = None) -> str:
+    """
+    Upload a file for the Assistant, unless the session has already uploaded the same content
+
+    Args:
+    - file (UploadedFile): The file to upload
+    - file_name (str): The name of the file, defaults to the name of the uploaded file
+
+    Returns:
+    - str: The id of the uploaded file
+    """
+    file_name = file.name if file_name is None else file_name
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(functools.partial(file.read, DOWNLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+
+    # Uploads are only shared within a session, as the apps delete their files once done
+    upload_key = f"{get_session_key()}:{digest.hexdigest()}"
+    uploaded_files = get_cache("uploaded_files")
+    file_id = uploaded_files.get(upload_key)
+    if file_id is None:
+        file_id = get_client().files.create(file=(file_name, file), purpose="assistants").id
+        uploaded_files.set(upload_key, file_id)
+        uploaded_files.set(f"file:{file_id}", upload_key)
+        print(f"Uploaded new file: \t {file_id}")
+    return file_id
 
 def delete_files(file_id_list: list[str]) -> None:
     """
@@ -128,10 +490,17 @@ def delete_files(file_id_list: list[str]) -> None:
     Args:
     - file_id_list (list[str]): List of file ids to delete
     """
+    uploaded_files = get_cache("uploaded_files")
     for file_id in file_id_list:
-        client.files.delete(file_id)
+        get_client().files.delete(file_id)
         print(f"Deleted file: \t {file_id}")
 
+        # Forget the upload, if the file was uploaded by `upload_file`
+        upload_key = uploaded_files.get(f"file:{file_id}")
+        if upload_key is not None:
+            uploaded_files.delete(upload_key)
+            uploaded_files.delete(f"file:{file_id}")
+
 def delete_thread(thread_id) -> None:
     """
     Delete the thread
@@ -139,7 +508,7 @@ def delete_thread(thread_id) -> None:
     Args:
     - thread_id (str): The id of the thread to delete
     """
-    client.beta.threads.delete(thread_id)
+    get_client().beta.threads.delete(thread_id)
     print(f"Deleted thread: \t {thread_id}")
 
 def remove_links(text: str) -> str:
@@ -173,28 +542,30 @@ def retrieve_messages_from_thread(thread_id: str) -> list[str]:
     Returns:
     - list[str]: List of assistant messages
     """
-    thread_messages = client.beta.threads.messages.list(thread_id)
+    thread_messages = get_client().beta.threads.messages.list(thread_id)
     assistant_messages = []
     for message in thread_messages.data:
         if message.role == "assistant":
             assistant_messages.append(message.id)
     return assistant_messages
 
-def retrieve_assistant_created_files(message_list: list[str]) -> list[str]:
+def retrieve_assistant_created_files(message_list: list[str], thread_id: Optional[str] = None) -> list[str]:
     """
     Retrieve the assistant-created files
 
     Args:
     - message_list (list[str]): List of assistant messages
+    - thread_id (str): The id of the thread, defaults to the session's thread
 
     Returns:
     - list[str]: List of assistant-created file ids
     """
+    thread_id = st.session_state.thread_id if thread_id is None else thread_id
     assistant_created_file_ids = []
     for message_id in message_list:
-        message = client.beta.threads.messages.retrieve(
+        message = get_client().beta.threads.messages.retrieve(
             message_id=message_id,
-            thread_id=st.session_state.thread_id,
+            thread_id=thread_id,
         )
 
         # Retrieve the attachments from the message, and the file ids from the attachments
@@ -202,7 +573,7 @@ def retrieve_assistant_created_files(message_list: list[str]) -> list[str]:
         for file_id in created_file_id:
             assistant_created_file_ids.append(file_id)        
 
-        # message_files = client.beta.threads.messages.files.list(
+        # message_files = get_client().beta.threads.messages.files.list(
         #     thread_id=st.session_state.thread_id,
         #     message_id=message_id)
         # for file in message_files.data:
@@ -210,235 +581,147 @@ def retrieve_assistant_created_files(message_list: list[str]) -> list[str]:
 
     return assistant_created_file_ids
 
-@st.experimental_fragment
-def render_download_files(file_id_list: list[str]) -> Tuple[list[bytes], list[str]]:
+def retrieve_file_metadata(file_id_list: list[str]) -> list[dict]:
     """
-    Download the files, renders a download button for each file, and returns the downloaded files
+    Retrieve the name, size and MIME type of the files, without their content
 
     Args:
-    - file_id_list (list[str]): List of file ids to download
+    - file_id_list (list[str]): List of file ids
 
     Returns:
-    - downloaded_files (list[object]): List of downloaded files
-    - file_names (list[str]): List of file names
+    - list[dict]: List of file metadata
     """
-    downloaded_files = []
-    file_names = []
-    if len(file_id_list) > 0:
-        st.markdown("### 📂  **Downloadable Files**")
-        for file_id_num, file_id in enumerate(file_id_list):
-            try: 
-                file_data = client.files.content(file_id)
-                file = file_data.read()
-                file_name = client.files.retrieve(file_id).filename
-                file_name = os.path.basename(file_name)
-
-                # # if file_name is `.csv`
-                # if file_name.endswith(".csv"):
-                #     try:
-                #         with open(f"static/{file_name}", "wb") as f:
-                #             f.write(file)
-                #     except:
-                #         # Convert bytes to string
-                #         csv_str = file.decode('utf-8')
-                #         csv_file = io.StringIO(csv_str)            
-                #         df = pd.read_csv(csv_file)
-                #         df.to_csv(f"static/{file_name}", index=False)
-                # elif file_name.endswith(".png"):
-                #     with open(f"static/{file_name}", "wb") as f:
-                #         f.write(file)
-                # st.write(f"- [{file_name}](static/{file_name})")
-
-                # Store the downloaded file and its name
-                downloaded_files.append(file)
-                file_names.append(file_name)
-
-                # Display the download button
-                st.download_button(label=f"{file_name}",
-                                    data=file,
-                                    file_name=file_name,
-                                    mime="text/csv")
-                                    
-            except: 
-                # Display the download button
-                file = st.session_state.download_files[file_id_num]
-                file_name = st.session_state.download_file_names[file_id_num]
-                st.download_button(label=f"{file_name}",
-                                    data=file,
-                                    file_name=file_name,
-                                    mime="text/csv")
-    
-    return downloaded_files, file_names
-    
+    def retrieve(file_id: str) -> dict:
+        file_object = get_client().files.retrieve(file_id)
+        file_name = os.path.basename(file_object.filename)
+        return {
+            "file_id": file_id,
+            "file_name": file_name,
+            "bytes": file_object.bytes,
+            "mime": mimetypes.guess_type(file_name)[0] or "application/octet-stream",
+        }
+
+    return [get_cache("file_metadata").get_or_set(file_id, functools.partial(retrieve, file_id))
+            for file_id in file_id_list]
+
+def fetch_file(file_id: str, path: str) -> str:
+    """
+    Stream the content of a file from OpenAI to the download store, chunk by chunk
 
-class EventHandler(AssistantEventHandler):
+    Args:
+    - file_id (str): The id of the file
+    - path (str): Where to save the file
+
+    Returns:
+    - str: The path of the saved file
     """
-    Event handler for the assistant stream
+    if not os.path.exists(path):
+        # Files with the same content share one copy on disk
+        with get_client().files.with_streaming_response.content(file_id) as response:
+            download_store.put(response.iter_bytes(DOWNLOAD_CHUNK_SIZE), path)
+    return path
+
+def build_zip_bundle(file_meta_list: list[dict], path: str) -> str:
     """
-    @override
-    def on_text_created(self, text: Text) -> None:
-        """
-        Handler for when a text is created
-        """
-        # This try-except block will update the earlier expander for code to complete.
-        # Note the indexing. We are updating the x-1 textbox where x is the current textbox.
-        # Note how `on_tool_call_done` creates a new textbook (which is the x_th textbox, so we want to access the x-1_th)
-        # This is to address an edge case where code is executed, but there is no output textbox (e.g. a graph is created)
-        try:
-            st.session_state[f"code_expander_{len(st.session_state.text_boxes) - 1}"].update(state="complete", expanded=False)
-        except KeyError:
-            pass
-
-        # Create a new text box
-        st.session_state.text_boxes.append(st.empty())
-        # Insert the text into the last element in assistant text list
-        st.session_state.assistant_text[-1] += "**> 🕵️ DAVE:** \n\n "
-        # Remove links from the text
-        st.session_state.assistant_text[-1] = remove_links(st.session_state.assistant_text[-1])
-        # Display the text in the newly created text box
-        st.session_state.text_boxes[-1].info("".join(st.session_state["assistant_text"][-1]))
-      
-    @override
-    def on_text_delta(self, delta: TextDelta, snapshot: Text):
-        """
-        Handler for when a text delta is created
-        """
-        # Clear the latest text box
-        st.session_state.text_boxes[-1].empty()
-        # If there is text written, add it to latest element in the assistant text list
-        if delta.value:
-            st.session_state.assistant_text[-1] += delta.value
-        # Remove links from the text
-        st.session_state.assistant_text[-1] = remove_links(st.session_state.assistant_text[-1])
-        # Re-display the full text in the latest text box
-        st.session_state.text_boxes[-1].info("".join(st.session_state["assistant_text"][-1]))
-
-    def on_text_done(self, text: Text):
-        """
-        Handler for when text is done
-        """
-        # Create new text box and element in the assistant text list
-        st.session_state.text_boxes.append(st.empty())
-        st.session_state.assistant_text.append("")
+    Stream the files into a single ZIP archive on disk, one chunk at a time
 
-    def on_tool_call_created(self, tool_call: ToolCall):
-        """
-        Handler for when a tool call is created
-        """
-        # Create new text box, which will contain code
-        st.session_state.text_boxes.append(st.empty())
-        # Create a new element in the code input list
-        st.session_state.code_input.append("")
-          
-    def on_tool_call_delta(self, delta: ToolCallDelta, snapshot: ToolCallDelta):
-        """
-        Handler for when a tool call delta is created
-        """
-        if delta.type == "code_interpreter" and delta.code_interpreter:
-
-            # Code writen by the assistant to be executed
-            if delta.code_interpreter.input:
-                # Go to the last text box
-                with st.session_state.text_boxes[-1]:
-                    # Check if a code box for this accompanying text box index exists
-                    if f"code_box_{len(st.session_state.text_boxes)}" not in st.session_state:
-                        # Nest the code in an expander
-                        st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"] = st.status("**💻 Code**", expanded=True)
-                        # Create an empty container which is the placeholder for the code box
-                        st.session_state[f"code_box_{len(st.session_state.text_boxes)}"] = st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"].empty()
-
-                # Clear the code box
-                st.session_state[f"code_box_{len(st.session_state.text_boxes)}"].empty()
-                # If there is code written, add it to the code input
-                if delta.code_interpreter.input:
-                    st.session_state.code_input[-1] += delta.code_interpreter.input
-                # Re-display the full code in the code box
-                st.session_state[f"code_box_{len(st.session_state.text_boxes)}"].code(st.session_state.code_input[-1])
-
-            # Output from the code executed by code interpreter
-            if delta.code_interpreter.outputs:
-                for output in delta.code_interpreter.outputs:
-                    if output.type == "logs":
-                        # This try-except block will update the earlier expander for code to complete.
-                        # Note the indexing, as we have not yet created a new text box for the code output.
-                        try:
-                            st.session_state[f"code_expander_{len(st.session_state.text_boxes)}"].update(state="complete", expanded=False)
-                        except KeyError:
-                            pass
-                        # Create a new element in the code input list, which is for the next code input
-                        st.session_state.code_input.append("")
-                        # Create a new text box, which is for the code output
-                        st.session_state.text_boxes.append(st.empty())
-                        # Nest the code output in an expander
-                        st.session_state.text_boxes[-1] = st.expander(label="**🔎 Output**")
-                        # Create a new element in the code output list
-                        st.session_state.code_output.append("")
-                        # Clear the latest text box which is for the code output
-                        st.session_state.text_boxes[-1].empty()
-                        # Add the logs to the code output
-                        st.session_state.code_output[-1] += f"\n\n{output.logs}"
-                        # Display the code output
-                        st.session_state.text_boxes[-1].code(st.session_state.code_output[-1])
-
-    def on_tool_call_done(self, tool_call: ToolCall):
-        """
-        Handler for when a tool call is done
-        """
-        # Create a new element in the code input list
-        st.session_state.code_input.append("")
-        # Create a new element in the code output list
-        st.session_state.code_output.append("")
-        # Create a new element in the assistant text list
-        st.session_state.assistant_text.append("")
-        # Create a new text box for the next operation
-        st.session_state.text_boxes.append(st.empty())
-
-    def on_image_file_done(self, image_file: ImageFile):
-        """
-        Handler for when an image file is done
-        """
-        # Download file from OpenAI
-        image_data = client.files.content(image_file.file_id)
-        img_name = image_file.file_id
-
-        # Save file
-        image_data_bytes = image_data.read()
-        with open(f"images/{img_name}.png", "wb") as file:
-            file.write(image_data_bytes)
-
-        # Open file and encode as data
-        file_ = open(f"images/{img_name}.png", "rb")
-        contents = file_.read()
-        data_url = base64.b64encode(contents).decode("utf-8")
-        file_.close()
-
-        # Create new text box
-        st.session_state.text_boxes.append(st.empty())
-        st.session_state.assistant_text.append("")
-        
-        # # Display image in textbox
-        image_html = f'<p align="center"><img src="data:image/png;base64,{data_url}" width=600></p>'
-        st.session_state.text_boxes[-1].html(image_html)
-
-        # st.session_state.text_boxes[-1].image(f"images/{img_name}.png", width=600)
-
-        # Create new text box
-        st.session_state.assistant_text.append("")
-        st.session_state.text_boxes.append(st.empty())
-        
-        # Delete file from OpenAI
-        client.files.delete(image_file.file_id)
-      
-    def on_timeout(self):
-        """
-        Handler for when the api call times out
-        """
-        st.error("The api call timed out.")
-        st.stop()
-
-    # def on_exception(self, exception: Exception):
-    #     """
-    #     Handler for when an exception occurs
-    #     """
-    #     st.error(f"An error occurred: {exception}")
-    #     st.stop()
+    Args:
+    - file_meta_list (list[dict]): List of file metadata
+    - path (str): Where to save the archive
+
+    Returns:
+    - str: The path of the saved archive
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with zipfile.ZipFile(f"{path}.part", "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            for file_meta in file_meta_list:
+                # Reuse the files already fetched, and stream the others straight into the archive
+                local_path = os.path.join(DOWNLOAD_DIR, file_meta["file_id"], file_meta["file_name"])
+                if os.path.exists(local_path):
+                    bundle.write(local_path, arcname=file_meta["file_name"])
+                    continue
+                with bundle.open(file_meta["file_name"], "w", force_zip64=True) as entry:
+                    with get_client().files.with_streaming_response.content(file_meta["file_id"]) as response:
+                        for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            entry.write(chunk)
+        os.replace(f"{path}.part", path)
+    return path
+
+def bundle_dir(file_id_list: list[str]) -> str:
+    """
+    Where the ZIP bundle of the files is saved, named after a hash of their ids so that
+    the name stays short however many files there are
+    """
+    return os.path.join(DOWNLOAD_DIR, "bundles", hash_text(",".join(sorted(file_id_list))))
+
+def delete_downloads(file_id_list: list[str]) -> None:
+    """
+    Delete the file(s) created by the Assistant, along with their local copies
+
+    Args:
+    - file_id_list (list[str]): List of file ids to delete
+    """
+    if not file_id_list:
+        return
+    delete_files(file_id_list)
+    for file_id in file_id_list:
+        shutil.rmtree(os.path.join(DOWNLOAD_DIR, file_id), ignore_errors=True)
+    shutil.rmtree(bundle_dir(file_id_list), ignore_errors=True)
+    # Delete the copies no other session links to
+    download_store.prune()
+
+def clean_up_abandoned_run(live_run) -> None:
+    """
+    Delete what a run left behind when no session came back to finalize it: the file(s) created
+    by the Assistant, the thread, the full logs, and the file(s) uploaded for the run, if any
+
+    Args:
+    - live_run (LiveRun): The run, see `run_registry`
+    """
+    assistant_messages = retrieve_messages_from_thread(live_run.thread_id)
+    delete_downloads(retrieve_assistant_created_files(assistant_messages, live_run.thread_id))
+    delete_thread(live_run.thread_id)
+    delete_logs([live_run.thread_id])
+    # Last, as the runs of a fan-out share their uploads, which only the first cleanup finds
+    delete_files(live_run.context.get("file_ids", []) + live_run.context.get("sample_file_ids", []))
+
+def render_download_button(label: str, path: str, file_name: str, mime: str, key: str) -> None:
+    """
+    Renders a download button for a file saved on disk
+    """
+    with open(path, "rb") as file:
+        st.download_button(label=label,
+                           data=file,
+                           file_name=file_name,
+                           mime=mime,
+                           key=key)
+
+@st.experimental_fragment
+def render_download_files(file_id_list: list[str]) -> None:
+    """
+    Renders a button for each file, which fetches the file on click and then offers it for download.
+    Only the metadata is retrieved until a file is clicked.
+
+    Args:
+    - file_id_list (list[str]): List of file ids to download
+    """
+    if len(file_id_list) > 0:
+        st.markdown("### 📂  **Downloadable Files**")
+        file_meta_list = retrieve_file_metadata(file_id_list)
+        for file_meta in file_meta_list:
+            file_id, file_name = file_meta["file_id"], file_meta["file_name"]
+            path = os.path.join(DOWNLOAD_DIR, file_id, file_name)
+            if os.path.exists(path) or st.button(f"{file_name} ({file_meta['bytes'] / 1024:,.1f} KB)",
+                                                 key=f"fetch_{file_id}"):
+                with st.spinner(f"Fetching {file_name}..."):
+                    fetch_file(file_id, path)
+                render_download_button(f"⬇️ {file_name}", path, file_name, file_meta["mime"], f"download_{file_id}")
+
+        # Offer all the files as a single ZIP bundle
+        if len(file_meta_list) > 1:
+            path = os.path.join(bundle_dir(file_id_list), "dave_files.zip")
+            if os.path.exists(path) or st.button("All files (.zip)", key="fetch_bundle"):
+                with st.spinner("Bundling the files..."):
+                    build_zip_bundle(file_meta_list, path)
+                render_download_button("⬇️ dave_files.zip", path, "dave_files.zip", "application/zip", "download_bundle")